@@ -0,0 +1,66 @@
+# helpers to run the plotting scripts headless, on many files at once
+import concurrent.futures
+import glob
+import click
+import matplotlib
+import matplotlib.pyplot as plt
+
+
+def use_headless_backend():
+    """
+    Forces the non-interactive 'Agg' backend, so plots are never shown and never block.
+    """
+    matplotlib.use('Agg', force=True)
+
+
+def expand_inputs(patterns) -> list[str]:
+    """
+    Expands paths and glob patterns into a sorted list of unique paths.
+    """
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} Nothing matches \"{pattern}\".")
+        paths.update(matches)
+    return sorted(paths)
+
+
+def output_name(input_path, suffix, fmt) -> str:
+    """
+    Names the output of one input. 'path/to/run_data.star' -> 'run_data_<suffix>.<fmt>'
+    """
+    stem = input_path.rstrip('/').split('/')[-1].removesuffix('.star')
+    return f"{stem}_{suffix}.{fmt}"
+
+
+def save_figure(input_path, make_figure, suffix, fmt, dpi, **kwargs) -> str:
+    """
+    Makes the figure for one input with make_figure(input_path, **kwargs), saves it, and closes it.
+    """
+    fig = make_figure(input_path, **kwargs)
+    out = output_name(input_path, suffix, fmt)
+    fig.savefig(out, dpi=dpi)
+    plt.close(fig)
+    return out
+
+
+def run_batch(func, inputs, workers=None, **kwargs):
+    """
+    Runs func(input, **kwargs) on every input across a process pool, with one output per input.
+    Every worker uses the headless backend. A failed input is reported and does not stop the others.
+    """
+    use_headless_backend()
+    click.echo(f"  Running headless on {len(inputs)} inputs...")
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=use_headless_backend) as exe:
+        futures = {exe.submit(func, path, **kwargs): path for path in inputs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                out = future.result()
+                if out is None:
+                    click.echo(f"    \"{futures[future]}\": nothing saved.")
+                else:
+                    click.echo(f"    \"{futures[future]}\" -> \"{out}\".")
+            except (Exception, SystemExit) as e:
+                click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} \"{futures[future]}\" failed: {e!r}")
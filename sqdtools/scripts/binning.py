@@ -0,0 +1,81 @@
+# helpers to count values into regular bins, once, for all classes at the same time, and to draw the counts
+import numpy as np
+from matplotlib.colors import LogNorm
+
+
+def gridsize_for_order(healpix_order) -> int:
+    """
+    Picks the 2D grid size for a HEALPix order. Order 2 samples every 15 deg, so 25 bins is enough up to it.
+    """
+    return 25 if healpix_order <= 2 else 50
+
+
+def grid_edges(values, gridsize) -> np.ndarray:
+    """
+    Splits the range of the values into gridsize even bins.
+    """
+    low, high = values.min(), values.max()
+    if low == high:
+        high = low + 1
+    return np.linspace(low, high, gridsize + 1)
+
+
+def bin_index(values, edges) -> np.ndarray:
+    """
+    Gives the bin of every value on evenly spaced edges, or -1 if it is outside them.
+    Like np.histogram, the last bin also holds values on its right edge.
+    """
+    n_bins = len(edges) - 1
+    width = (edges[-1] - edges[0]) / n_bins
+    index = np.full(np.shape(values), -1, dtype=np.intp)
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    kept = values[inside]
+    kept_index = np.clip(np.floor((kept - edges[0]) / width).astype(np.intp), 0, n_bins - 1)
+    # rounding can put a value next to its bin, so check it against the edges themselves, as np.histogram does
+    kept_index[kept < edges[kept_index]] -= 1
+    kept_index[(kept >= edges[kept_index + 1]) & (kept_index != n_bins - 1)] += 1
+    index[inside] = kept_index
+    return index
+
+
+def class_codes(class_numbers, classes) -> np.ndarray:
+    """
+    Gives the position of every particle's class in the sorted classes, or -1 if it is not one of them.
+    """
+    classes = np.asarray(classes)
+    position = np.searchsorted(classes, class_numbers)
+    position[position == len(classes)] = 0
+    return np.where(classes[position] == class_numbers, position, -1)
+
+
+def grouped_counts(codes, n_groups, indices, shape) -> np.ndarray:
+    """
+    Counts (group, bin...) pairs with one bincount. Returns an array of shape (n_groups, *shape).
+    codes and every array in indices are -1 where a value is left out.
+    """
+    keep = codes >= 0
+    for index in indices:
+        keep &= index >= 0
+
+    flat = np.ravel_multi_index((codes[keep], *(index[keep] for index in indices)), (n_groups, *shape))
+    counts = np.bincount(flat, minlength=n_groups * int(np.prod(shape)))
+    return counts.reshape(n_groups, *shape)
+
+
+def grid_counts(x, y, x_edges, y_edges) -> np.ndarray:
+    """
+    Counts x, y points on a regular grid with one raveled bincount. Returns (x-bin x y-bin) counts.
+    """
+    codes = np.zeros(len(x), dtype=np.intp)
+    shape = (len(x_edges) - 1, len(y_edges) - 1)
+    return grouped_counts(codes, 1, [bin_index(x, x_edges), bin_index(y, y_edges)], shape)[0]
+
+
+def draw_counts(ax, counts, x_edges, y_edges, vmax=None):
+    """
+    Draws precomputed (x-bin x y-bin) counts as a log scaled image. Empty bins are left blank, as in hexbin.
+    The image is a single raster, so the plot size does not grow with the number of particles.
+    """
+    vmax = counts.max() if vmax is None else vmax
+    return ax.imshow(counts.T, origin='lower', aspect='auto', interpolation='nearest',
+                     extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), norm=LogNorm(vmin=1, vmax=max(vmax, 1)))
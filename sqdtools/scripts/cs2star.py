@@ -4,6 +4,8 @@ import click
 import os
 import starfile
 import json
+import pandas as pd
+import concurrent.futures
 
 
 def get_relion_paths(json_file) -> dict[str]:
@@ -58,21 +60,276 @@ def set_paths(paths_from_json, paths_from_cli):
     return paths_from_cli.get('star'), paths_from_cli.get('relion_project_dir')
 
 
-def resolve_symlinks(file_path, cs_project_path, relion_project_dir):
-    path = file_path.split()[0].split('@')[1]
-    abs_path = os.path.join(cs_project_path, path)  # Generate an absolute path for CS import
+def load_cs(cs_file, fields) -> np.ndarray:
+    """
+    Memory-maps a cryoSPARC '.cs' file without reading it into memory.
+    Only the pages of the requested fields are read when they are accessed.
+    """
+    cs = np.load(cs_file, mmap_mode='r')
+
+    # exit if the .cs file does not have the fields needed
+    missing_fields = [field for field in fields if field not in cs.dtype.names]
+    if missing_fields:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} \"{cs_file.split('/')[-1]}\" is missing the fields: {', '.join(missing_fields)}")
+        raise ValueError()
+
+    return cs
+
+
+def factorize_blob_paths(blob_paths, chunk_size=1_000_000) -> tuple[list[str], np.ndarray]:
+    """
+    Factorizes the 'blob/path' bytes into integer codes, one chunk at a time.
+    Returns the decoded unique paths and a code for each particle that indexes into them.
+    Only the unique paths become python strings.
+    """
+    codes = np.empty(len(blob_paths), dtype=np.int32)
+    lookup = {}
+
+    for start in range(0, len(blob_paths), chunk_size):
+        chunk = np.asarray(blob_paths[start:start + chunk_size])
+        unique_chunk, inverse = np.unique(chunk, return_inverse=True)
+
+        # give each new path the next code, then map the chunk through it
+        chunk_codes = np.array([lookup.setdefault(path, len(lookup)) for path in unique_chunk], dtype=np.int32)
+        codes[start:start + len(chunk)] = chunk_codes[inverse.ravel()]
+
+    unique_paths = [path.decode('utf-8') for path in lookup]
+    return unique_paths, codes
 
-    if not os.path.exists(abs_path):
-        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} The file \"{abs_path}\" does not exist.\nAre you in your cryoSPARC directory? \nTry using the \"--cs_project_dir\" flag")
+
+def resolve_symlinks(stack_paths, cs_project_path, relion_project_dir) -> dict[str]:
+    """
+    Resolves each unique cryoSPARC stack path to a path relative to the RELION directory.
+    Every stack is checked once, no matter how many particles it holds.
+    Returns a dictionary of {cryoSPARC path: RELION path}.
+    """
+    resolved_paths = {}
+    missing_paths = []
+
+    for path in stack_paths:
+        abs_path = os.path.join(cs_project_path, path)  # Generate an absolute path for CS import
+
+        if not os.path.exists(abs_path):
+            missing_paths.append(abs_path)
+            continue
+
+        if os.path.islink(abs_path):
+            original_path = os.readlink(abs_path)
+            resolved_paths[path] = original_path.replace(relion_project_dir + '/', '')  # Makes path relative to relion directory
+        else:
+            resolved_paths[path] = path
+
+    # report every stack that could not be found, not just the first
+    if missing_paths:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} {len(missing_paths):,} files do not exist:")
+        for abs_path in missing_paths:
+            click.echo(f"    \"{abs_path}\"")
+        click.echo("  Are you in your cryoSPARC directory? \n  Try using the \"--cs_project_dir\" flag")
 
         raise FileNotFoundError()
 
-    if os.path.islink(abs_path):
-        original_path = os.readlink(abs_path)
-        modified_original_path = original_path.replace(relion_project_dir + '/', '')  # Makes path relative to relion directory
-        resolved_line = file_path.replace(path, modified_original_path)  # Replaces CS path with relion path
+    return resolved_paths
+
+
+def build_image_names(blob_idx, path_codes, stack_paths) -> np.ndarray:
+    """
+    Builds RELION style 'idx@path' names from per particle indexes and stack path codes.
+    'path_codes' index into 'stack_paths', so each path string is only made once.
+    """
+    stack_paths = np.asarray(stack_paths, dtype=str)
+    prefixes = np.char.add(blob_idx.astype(str), '@')
+    return np.char.add(prefixes, stack_paths[path_codes])
+
+
+def split_image_names(image_names, stack_paths) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Splits RELION 'idx@path' names into an integer image index and a stack path code.
+    Codes index into 'stack_paths', and are -1 for stacks that are not in it.
+    Leading zeros in the index are dropped by the integer conversion.
+    """
+    parts = pd.Series(image_names).str.partition('@')
+    image_idx = pd.to_numeric(parts[0]).to_numpy(np.int64)
+
+    # factorize the star paths, then only look up the unique ones
+    star_codes, star_stacks = pd.factorize(parts[2])
+    stack_codes = pd.Index(stack_paths).get_indexer(star_stacks)
+    path_codes = stack_codes[star_codes]
+
+    return image_idx, path_codes
+
+
+def particle_keys(image_idx, path_codes) -> np.ndarray:
+    """
+    Packs an image index and a stack path code into a single int64 key.
+    """
+    return (path_codes.astype(np.int64) << 32) | image_idx.astype(np.int64)
+
+
+def join_particles(image_names, blob_idx, path_codes, stack_paths) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Matches STAR particles to cryoSPARC particles on integer (index, stack) keys with a sort-merge join.
+    Returns a mask of the STAR rows to keep, the cryoSPARC particle matched to each kept row,
+    and a mask of the cryoSPARC particles that were not found.
+    """
+    star_idx, star_codes = split_image_names(image_names, stack_paths)
+    star_keys = particle_keys(star_idx, star_codes)
+    star_keys[star_codes < 0] = -1  # stacks unknown to cryoSPARC never match
+    cs_keys = particle_keys(blob_idx, path_codes)
+
+    # look up every star key in the sorted cryoSPARC keys
+    order = np.argsort(cs_keys, kind='stable')
+    sorted_keys = cs_keys[order]
+    position = np.searchsorted(sorted_keys, star_keys).clip(max=len(sorted_keys) - 1)
+
+    keep = sorted_keys[position] == star_keys if len(sorted_keys) else np.zeros(len(star_keys), dtype=bool)
+    matched = order[position[keep]]
+    missing = ~np.isin(cs_keys, star_keys)
+
+    return keep, matched, missing
+
+
+def rotvec_to_euler(rotvecs) -> np.ndarray:
+    """
+    Converts cryoSPARC rotation vectors (radians) to RELION ZYZ Euler angles (degrees).
+    Works on the whole (n, 3) array at once, only the matrix entries that are needed are computed.
+    """
+    rotvecs = np.asarray(rotvecs, dtype=np.float64)
+    theta = np.linalg.norm(rotvecs, axis=1)
+    x, y, z = (rotvecs / np.where(theta > 0, theta, 1)[:, None]).T
+    s, c = np.sin(theta), 1 - np.cos(theta)
+
+    # Rodrigues' formula, with the same handedness as cryoSPARC/pyem
+    r00 = 1 + c * (x * x - 1)
+    r02 = -s * y + c * x * z
+    r10 = -s * z + c * x * y
+    r12 = s * x + c * y * z
+    r20 = s * y + c * x * z
+    r21 = -s * x + c * y * z
+    r22 = 1 + c * (z * z - 1)
+
+    # Decompose like RELION's Euler_matrix2angles, including gimbal lock
+    abs_sb = np.sqrt(r02 ** 2 + r12 ** 2)
+    regular = abs_sb > 16 * np.finfo(np.float64).eps
+    flipped = r22 < 0
 
-    return resolved_line
+    rot = np.where(regular, np.arctan2(r21, r20), 0)
+    tilt = np.where(regular, np.arctan2(abs_sb, r22), np.where(flipped, np.pi, 0))
+    psi = np.where(regular, np.arctan2(r12, -r02), np.where(flipped, np.arctan2(r10, -r00), np.arctan2(-r10, r00)))
+
+    return np.degrees(np.stack([rot, tilt, psi], axis=1))
+
+
+def cs_to_relion_fields(cs, rows) -> dict[str]:
+    """
+    Converts the cryoSPARC alignment and CTF fields of the selected rows to RELION columns.
+    Optional fields are only converted if they are in the .cs file.
+    """
+    fields = {}
+
+    euler = rotvec_to_euler(cs['alignments3D/pose'][rows])
+    fields['rlnAngleRot'], fields['rlnAngleTilt'], fields['rlnAnglePsi'] = euler.T
+
+    # cryoSPARC shifts are in pixels, RELION origins are in Angstroms
+    psize_field = 'alignments3D/psize_A' if 'alignments3D/psize_A' in cs.dtype.names else 'blob/psize_A'
+    shifts = cs['alignments3D/shift'][rows] * cs[psize_field][rows][:, None]
+    fields['rlnOriginXAngst'], fields['rlnOriginYAngst'] = shifts.T
+
+    fields['rlnDefocusU'] = cs['ctf/df1_A'][rows]
+    fields['rlnDefocusV'] = cs['ctf/df2_A'][rows]
+    fields['rlnDefocusAngle'] = np.degrees(cs['ctf/df_angle_rad'][rows])
+
+    if 'ctf/phase_shift_rad' in cs.dtype.names:
+        fields['rlnPhaseShift'] = np.degrees(cs['ctf/phase_shift_rad'][rows])
+    if 'ctf/bfactor' in cs.dtype.names:
+        fields['rlnCtfBfactor'] = cs['ctf/bfactor'][rows]
+
+    return fields
+
+
+def extract_subset(star, relion_project_dir, cs_project_path, stack_paths, blob_idx, path_codes, cs_rows, missing_out) -> tuple[dict, np.ndarray]:
+    """
+    Resolves the stacks that came from one RELION STAR file and extracts their particles from it.
+    'path_codes' index into 'stack_paths'. Returns the subset and the .cs row of each of its particles.
+    """
+    # Resolve the cs path symbolic links to relion paths, once per stack
+    click.echo(f"  Resolving symbolic links for {len(stack_paths):,} stacks from \"{star.split('/')[-1]}\"...")
+    resolved_stacks = resolve_symlinks(stack_paths, cs_project_path, relion_project_dir)
+    resolved_stack_paths = [resolved_stacks[path] for path in stack_paths]
+
+    # Intersect the star file against the particle indexes and stacks
+    click.echo(f"  Extracting a subset from \"{star.split('/')[-1]}\"...")  # Gets file name from the path
+    df = starfile.read(star)
+
+    keep, matched, missing = join_particles(df['particles']['rlnImageName'], blob_idx, path_codes, resolved_stack_paths)
+    df['particles'] = df['particles'][keep]
+
+    # Checks that every cryoSPARC particle was found, if not something went wrong
+    if missing.any():
+        missing_names = build_image_names(blob_idx[missing], path_codes[missing], resolved_stack_paths)
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} {len(missing_names):,} of {len(blob_idx):,} particles were not found in \"{star.split('/')[-1]}\":")
+        for name in missing_names[:10]:
+            click.echo(f"    {name}")
+        if len(missing_names) > 10:
+            np.savetxt(missing_out, missing_names, fmt='%s')
+            click.echo(f"    ... full list written to \"{missing_out}\".")
+        raise ValueError()
+
+    return df, cs_rows[matched]
+
+
+def group_by_import_job(blob_paths, cs_project_path) -> list[dict]:
+    """
+    Groups the stacks by import job and reads each 'job.json' for its STAR file and RELION directory.
+    Import jobs that point at the same STAR file share a group, so each STAR file is read once.
+    """
+    import_jobs = [path.split('/')[0] for path in blob_paths]
+
+    groups = {}
+    for job in dict.fromkeys(import_jobs):
+        click.echo(f"\n  Import job {job}:")
+        paths_from_json = get_relion_paths(f"{cs_project_path}/{job}/job.json")
+        key = (paths_from_json['star'], paths_from_json['relion_project_dir'])
+        groups.setdefault(key, {"star": key[0], "relion_project_dir": key[1], "jobs": [], "stacks": []})
+        groups[key]['jobs'].append(job)
+
+    # assign every stack to the group of its import job
+    job_to_group = {job: group for group in groups.values() for job in group['jobs']}
+    for code, job in enumerate(import_jobs):
+        job_to_group[job]['stacks'].append(code)
+
+    return list(groups.values())
+
+
+def merge_subsets(subsets) -> dict:
+    """
+    Combines STAR subsets from different RELION STAR files into one.
+    Optics groups are renumbered, and renamed if needed, so they stay unique across the subsets.
+    """
+    optics_tables = []
+    particle_tables = []
+    optics_names = set()
+    offset = 0
+
+    for n, df in enumerate(subsets, start=1):
+        optics_df = df['optics'].copy()
+        particles_df = df['particles'].copy()
+
+        renumber = {group: i for i, group in enumerate(optics_df['rlnOpticsGroup'], start=offset + 1)}
+        optics_df['rlnOpticsGroup'] = optics_df['rlnOpticsGroup'].map(renumber)
+        particles_df['rlnOpticsGroup'] = particles_df['rlnOpticsGroup'].map(renumber)
+        offset += len(optics_df)
+
+        if 'rlnOpticsGroupName' in optics_df:
+            if optics_names.intersection(optics_df['rlnOpticsGroupName']):
+                optics_df['rlnOpticsGroupName'] = optics_df['rlnOpticsGroupName'] + f"_{n}"
+            optics_names.update(optics_df['rlnOpticsGroupName'])
+
+        optics_tables.append(optics_df)
+        particle_tables.append(particles_df)
+
+    return {
+        'optics': pd.concat(optics_tables, ignore_index=True),
+        'particles': pd.concat(particle_tables, ignore_index=True)}
 
 
 def validate_extension(path, extension):
@@ -126,12 +383,16 @@ def activate_required_flags(ctx, param, value):
 @click.option('--c', '--cs_project_dir', 'cs_project_path', required=False, type=click.Path(exists=True, resolve_path=True), help="Path to the cryoSPARC project directoy")
 # --o name of the output STAR file
 @click.option('--o', '--out', 'out', default='filtered_particles.star', show_default=True, help="Optional name for the output STAR file", metavar='<filtered_particles.star>')
-def cli(passthrough, star, relion_project_dir, out, cs_project_path, automatic):
+# --w number of STAR files to resolve at once when particles come from multiple import jobs
+@click.option('--w', '--workers', 'workers', type=int, help="Number of STAR files to resolve in parallel. Defaults to the number of CPUs.", metavar='<n>')
+# --k carries the cryoSPARC alignments and CTF into the output STAR file
+@click.option('--k', '--keep_alignments', 'keep_alignments', is_flag=True, help="Replace the RELION angles, origins and CTF with those from the cryoSPARC file")
+def cli(passthrough, star, relion_project_dir, out, cs_project_path, automatic, workers, keep_alignments):
     """
     Converts cryoSPARC '.cs' to RELION '.star' by an intersection operation.
     Only particle STAR files are supported.
-    Alignment and CTF information from cryoSPARC are not preserved.
-    Converting .cs files that descend from multiple import jobs is not supported.
+    Alignment and CTF information from cryoSPARC are only preserved with '--k'.
+    With '--a', particles from multiple import jobs are resolved in parallel and merged.
     """
 
     # Validate the inputs
@@ -145,32 +406,32 @@ def cli(passthrough, star, relion_project_dir, out, cs_project_path, automatic):
     if not cs_project_path:
         cs_project_path = os.path.dirname(os.path.dirname(os.path.abspath(passthrough)))  # i know, i'm sorry
 
-    # merge index and path of cs paticles into a list to intersect
-    # read in the .cs numpy array
+    # memory-map the .cs numpy array, only the fields that are used are read
     click.echo(f"  Reading \"{passthrough.split('/')[-1]}\".")  # Gets file name from the path
-    cs = np.load(passthrough)
+    fields = ['blob/path', 'blob/idx']
+    if keep_alignments:
+        fields += ['alignments3D/pose', 'alignments3D/shift', 'ctf/df1_A', 'ctf/df2_A', 'ctf/df_angle_rad']
+    cs = load_cs(passthrough, fields)
 
-    # parse blob paths into a list
-    blobPath = [path.decode('utf-8') for path in cs['blob/path']]
+    # factorize blob paths, only the unique stacks are decoded
+    blobPath, path_codes = factorize_blob_paths(cs['blob/path'])
 
-    # parse og indexes for each blob into a list
+    # parse og indexes for each blob, relion indexes start at 1
     blobIdx = cs['blob/idx'] + 1
 
-    # zip them together to look like relion
-    merged = [f"{index}@{path}" for index, path in zip(blobIdx, blobPath)]
-
     # try to get relion paths
     if automatic:
 
         # get the name of unique import jobs
         unique_import_jobs = {path.split('/')[0] for path in blobPath}
 
-        # exit if more than 1 import job found
+        # parse the STAR and RELION data from each job.json file
         if len(unique_import_jobs) > 1:
-            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Multiple import jobs found: {unique_import_jobs}. Converting from multiple import jobs is not supported.")
-            exit()
+            click.echo(f"  Found {len(unique_import_jobs)} import jobs: {', '.join(sorted(unique_import_jobs))}.")
+            if star or relion_project_dir:
+                click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} '--s' and '--r' are ignored with multiple import jobs.")
+            groups = group_by_import_job(blobPath, cs_project_path)
 
-        # parse the STAR and RELION data from job.json file
         else:
             # set path of import job.json file
             json_path = f"{cs_project_path}/{unique_import_jobs.pop()}/job.json"
@@ -180,27 +441,40 @@ def cli(passthrough, star, relion_project_dir, out, cs_project_path, automatic):
 
             # reassigns --s or --r to the values from job.json if they are None
             star, relion_project_dir = set_paths(paths_from_json, {"star": star, "relion_project_dir": relion_project_dir})
+            groups = [{"star": star, "relion_project_dir": relion_project_dir, "stacks": list(range(len(blobPath)))}]
 
-    # Resolve the cs path symbolic links to relion paths
-    click.echo("\n  Resolving symbolic links...")
-    resolved_paths = [resolve_symlinks(line, cs_project_path, relion_project_dir) for line in merged]
-
-    # Intersect the star file against the list of particle paths
-    click.echo(f"  Extracting a subset from \"{star.split('/')[-1]}\"...")  # Gets file name from the path
-    df = starfile.read(star)
-
-    # Strip leading zeros
-    df['particles']['rlnImageName'] = df['particles']['rlnImageName'].apply(lambda s: s.lstrip("0"))
-
-    filter = df['particles']['rlnImageName'].isin(resolved_paths)
-    df['particles'] = df['particles'][filter]
+    else:
+        groups = [{"star": star, "relion_project_dir": relion_project_dir, "stacks": list(range(len(blobPath)))}]
+
+    # Resolve and extract each STAR file's particles concurrently
+    click.echo("")
+    with concurrent.futures.ThreadPoolExecutor(workers) as exe:
+        futures = []
+        for i, group in enumerate(groups):
+            # give the group's stacks local codes, and select its particles
+            group_stacks = np.asarray(group['stacks'])
+            local_codes = np.full(len(blobPath), -1, dtype=np.int32)
+            local_codes[group_stacks] = np.arange(len(group_stacks), dtype=np.int32)
+            in_group = local_codes[path_codes] >= 0
+
+            missing_out = f"{out.removesuffix('.star')}_missing.txt" if len(groups) == 1 else f"{out.removesuffix('.star')}_{i + 1}_missing.txt"
+            futures.append(exe.submit(
+                extract_subset, group['star'], group['relion_project_dir'], cs_project_path,
+                [blobPath[code] for code in group_stacks], blobIdx[in_group], local_codes[path_codes[in_group]],
+                np.flatnonzero(in_group), missing_out))
+
+        subsets, matched_rows = zip(*[future.result() for future in futures])
+
+    df = subsets[0] if len(subsets) == 1 else merge_subsets(subsets)
+
+    # Overwrite the RELION alignments and CTF with the ones from cryoSPARC
+    if keep_alignments:
+        click.echo("  Converting cryoSPARC alignments and CTF...")
+        fields = cs_to_relion_fields(cs, np.concatenate(matched_rows))
+        for column, values in fields.items():
+            df['particles'][column] = values
 
     number_found = len(df['particles'])
-    # Checks that both starfiles are the same size, if not something went wrong
-    if len(resolved_paths) != number_found:
-        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Some particles were not found: {len(resolved_paths):,} != {number_found:,}")
-        raise ValueError()
-
     click.echo(f"    Found {number_found:,} particles in common.")
 
     # Writes the new star file
@@ -1,13 +1,17 @@
 # a python script to plot histograms of data, etc...
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import click
 from ast import literal_eval
-from starfile_rs import read_star
+from sqdtools.scripts.batch import expand_inputs, run_batch, save_figure
+from sqdtools.scripts.star_io import read_columns, scan_header
+from sqdtools.scripts.binning import bin_index, class_codes, grouped_counts
 
 
 def load_data(filename, data_column):
-    star_df = read_star(filename)
+    # only the header is read until the columns are checked
+    star_df = scan_header(filename)
 
     # check if the starfile is for micrographs, or particles, but not both
     match star_df:
@@ -22,8 +26,7 @@ def load_data(filename, data_column):
             click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} unknown star file type.")
             exit()
 
-    star_df = star_df[star_file_type].to_pandas()
-    valid_data_columns = star_df.columns.tolist()
+    valid_data_columns = star_df[star_file_type]
 
     # print the data columns in the star file and quit
     if data_column == "list":
@@ -40,11 +43,11 @@ def load_data(filename, data_column):
             print(f"   {item}")
         exit()
 
-    # make a dataframe of only what is needed
+    # parse only what is needed, in compact dtypes
     if star_file_type == 'particles':
-        data = star_df[['rlnClassNumber', data_column]]
+        data = read_columns(filename, star_file_type, ['rlnClassNumber', data_column], {'rlnClassNumber': 'int32', data_column: 'float32'})
     elif star_file_type == 'micrographs':
-        data = star_df[[data_column]]
+        data = read_columns(filename, star_file_type, [data_column], {data_column: 'float32'})
 
     return data, star_file_type
 
@@ -59,21 +62,54 @@ def fdb(data):
     # Calculate the bin width using the Freedman-Diaconis rule
     bin_width = 2 * iqr / np.cbrt(len(data))
     # Calculate the number of bins
-    num_bins = int(np.ceil((max(data) - min(data)) / bin_width))
-    return num_bins
+    num_bins = int(np.ceil((data.max() - data.min()) / bin_width))
+    return max(num_bins, 1)
 
 
-def calculate_bins(bin_width, dataframe):
+def calculate_bins(bin_width, data):
     bin_width = float(bin_width)
-    bins = np.arange(min(dataframe), max(dataframe) + bin_width, bin_width)
+    bins = np.arange(data.min(), data.max() + bin_width, bin_width)
     return bins
 
 
-def histogram(df, data_column, classes, star_file_type, bin_width, x_range):
-    bins = fdb(df[data_column]) if not bin_width else calculate_bins(bin_width, df[data_column])
+def bin_edges(data, bin_width) -> np.ndarray:
+    """
+    Computes evenly spaced bin edges, by the Freedman-Diaconis rule or from a bin width.
+    """
+    if bin_width:
+        return calculate_bins(bin_width, data)
+    return np.linspace(data.min(), data.max(), fdb(data) + 1)
+
+
+def count_bins(data, edges) -> np.ndarray:
+    """
+    Counts the data in evenly spaced bins. Only the counts are kept, not the data.
+    Bins the same way as the split by class counts, so those add up to these.
+    """
+    index = bin_index(data, edges)
+    return np.bincount(index[index >= 0], minlength=len(edges) - 1)
+
+
+def export_counts(filename, edges, counts, classes=None):
+    """
+    Writes the bin edges and counts to a .csv or .npz file, so runs can be compared without plotting.
+    counts is 1D, or (classes x bins) when split by class.
+    """
+    if filename.endswith('.npz'):
+        np.savez(filename, edges=edges, counts=counts, classes=np.asarray(classes if classes is not None else []))
+        return
+
+    columns = {'bin_left': edges[:-1], 'bin_right': edges[1:]}
+    if counts.ndim == 1:
+        columns['count'] = counts
+    else:
+        columns.update({f'Class {class_number}': class_counts for class_number, class_counts in zip(classes, counts)})
+    pd.DataFrame(columns).to_csv(filename, index=False)
+
 
+def histogram(counts, edges, data_column, classes, star_file_type, x_range):
     fig, ax = plt.subplots(1, 1, sharex=True, tight_layout=True)
-    ax.hist(df[data_column], bins=bins, color='purple')
+    ax.stairs(counts, edges, fill=True, color='purple')
 
     if x_range:
         x_min, x_max = x_range
@@ -92,19 +128,15 @@ def histogram(df, data_column, classes, star_file_type, bin_width, x_range):
     return fig
 
 
-def histogram_by_class(df, data_column, classes, bin_width, x_range, star_file_type):
-    bins = fdb(df[data_column]) if not bin_width else calculate_bins(bin_width, df[data_column])
-
+def histogram_by_class(counts, edges, data_column, classes, x_range, star_file_type):
     fig, axs = plt.subplots(len(classes), 1, sharex=True, sharey=False, tight_layout=True)
 
     # Deal with edge case of 1 class passed
     if len(classes) == 1:  # or not by_class:
         axs = [axs]
 
-    for ax, class_number in zip(axs, classes):
-        filter = df['rlnClassNumber'] == class_number
-        class_data = df[filter][data_column]
-        ax.hist(class_data, bins=bins, color='purple')
+    for ax, class_number, class_counts in zip(axs, classes, counts):
+        ax.stairs(class_counts, edges, fill=True, color='purple')
 
         if x_range:
             x_min, x_max = x_range
@@ -129,20 +161,10 @@ def validate_extension(path, extension):
         raise ValueError()
 
 
-@click.command(no_args_is_help=True)
-@click.option('--i', '--input', 'input_file', required=True, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
-@click.option('--data_column', 'data_column', default='rlnDefocusU', show_default=True, type=str, help="RELION data column to plot. \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
-@click.option('--by_class', is_flag=True, help="Split by class. Ignored for micrograph star files.")
-@click.option('--c', '--classes', 'classes', multiple=True, help="Specify which class to plot. You can specify multiple. Ignored for micrograph star files.", metavar='<class number>')
-@click.option('--x', '--x_range', 'x_range', type=(float, float), help="Specify X-axis scale. Pass as two values.", metavar='<min> <max>')
-@click.option('--b', '--bin_width', 'bin_width', type=str, help="Manualy specify bin width.", metavar='<bin width>')
-@click.option('--o', '--output', 'out', is_flag=False, flag_value="histogram_output.pdf", help="Optional name for the output file.", metavar='<output.pdf>')
-def cli(input_file, data_column, classes, by_class, bin_width, x_range, out):
+def make_figure(input_file, data_column, classes, by_class, bin_width, x_range, export=None):
     """
-    Plots a histogram.
-    Defaults to Defocus plots.
+    Reads one STAR file and plots its histogram.
     """
-
     # Validate the inputs
     input_file = validate_extension(input_file, '.star')
 
@@ -164,17 +186,69 @@ def cli(input_file, data_column, classes, by_class, bin_width, x_range, out):
         classes = None
         by_class = None
 
+    # count once on a float32 view, then only the counts are plotted
+    values = data[data_column].to_numpy(np.float32)
+    edges = bin_edges(values, bin_width)
+
+    if by_class:
+        # class and bin of every particle once, then all classes in one bincount
+        codes = class_codes(data['rlnClassNumber'].to_numpy(), classes)
+        counts = grouped_counts(codes, len(classes), [bin_index(values, edges)], (len(edges) - 1,))
+    else:
+        counts = count_bins(values, edges)
+
+    if export:
+        export_file = f"{input_file.split('/')[-1].removesuffix('.star')}_histogram_counts.{export}"
+        click.echo(f"  Writing counts to \"{export_file}\"...")
+        export_counts(export_file, edges, counts, classes if by_class else None)
+
     if by_class:
         click.echo("  Plotting data by class...")
-        histogram_by_class(data, data_column, classes, bin_width, x_range, star_file_type)
+        return histogram_by_class(counts, edges, data_column, classes, x_range, star_file_type)
     else:
         click.echo("  Plotting data...")
-        histogram(data, data_column, classes, star_file_type, bin_width, x_range)
+        return histogram(counts, edges, data_column, classes, star_file_type, x_range)
+
+
+@click.command(no_args_is_help=True)
+@click.option('--i', '--input', 'input_file', required=False, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
+@click.option('--data_column', 'data_column', default='rlnDefocusU', show_default=True, type=str, help="RELION data column to plot. \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
+@click.option('--by_class', is_flag=True, help="Split by class. Ignored for micrograph star files.")
+@click.option('--c', '--classes', 'classes', multiple=True, help="Specify which class to plot. You can specify multiple. Ignored for micrograph star files.", metavar='<class number>')
+@click.option('--x', '--x_range', 'x_range', type=(float, float), help="Specify X-axis scale. Pass as two values.", metavar='<min> <max>')
+@click.option('--b', '--bin_width', 'bin_width', type=str, help="Manualy specify bin width.", metavar='<bin width>')
+@click.option('--o', '--output', 'out', is_flag=False, flag_value="histogram_output.pdf", help="Optional name for the output file.", metavar='<output.pdf>')
+@click.option('--e', '--export', 'export', type=click.Choice(['csv', 'npz']), help="Also write the bin edges and counts to '<input>_histogram_counts.csv' or '.npz'.")
+@click.option('--batch', 'batch', multiple=True, help="Run headless on every .star file matching this path or glob, writing one plot per file. Can be passed multiple times.", metavar='<"*.star">')
+@click.option('--format', 'fmt', type=click.Choice(['pdf', 'png']), default='pdf', show_default=True, help="Plot format for --batch.")
+@click.option('--dpi', 'dpi', type=int, default=300, show_default=True, help="Resolution of the saved plots.")
+@click.option('--w', '--workers', 'workers', type=int, help="Number of files to plot at once with --batch.", metavar='<n>')
+def cli(input_file, data_column, classes, by_class, bin_width, x_range, out, export, batch, fmt, dpi, workers):
+    """
+    Plots a histogram.
+    Defaults to Defocus plots.
+    """
+
+    plot_options = {'data_column': data_column, 'classes': classes, 'by_class': by_class, 'bin_width': bin_width, 'x_range': x_range, 'export': export}
+
+    if batch and input_file is not None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Pass either '--i' or '--batch', not both.")
+        exit()
+
+    # headless, one plot per file, never shown
+    if batch:
+        run_batch(save_figure, expand_inputs(batch), workers, make_figure=make_figure, suffix='histogram', fmt=fmt, dpi=dpi, **plot_options)
+        return
+
+    if input_file is None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing option '--i' (or '--batch').")
+        exit()
+
+    make_figure(input_file, **plot_options)
 
     if out:
         # histogram.figsize = (11.80, 8.85)
-        # histogram.dpi = 300
-        plt.savefig(out)
+        plt.savefig(out, dpi=dpi)
         plt.show()
     else:
         plt.show()
@@ -1,13 +1,17 @@
 # a python script to plot histograms of defocus, etc...
 #import starfile
-from starfile_rs import read_star
 import matplotlib.pyplot as plt
+import numpy as np
+import healpy as hp
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import click
 from os import listdir as os_listdir, path as os_path
 import ast
 import time
 import functools
+from sqdtools.scripts.batch import expand_inputs, run_batch, save_figure
+from sqdtools.scripts.star_io import read_columns, scan_header
+from sqdtools.scripts.binning import bin_index, class_codes, draw_counts, grid_counts, grid_edges, gridsize_for_order, grouped_counts
 
 
 """
@@ -61,7 +65,8 @@ def timer(func):
 def load_data(filename, data_column_x, data_column_y):
     click.echo(f"  Reading \"{filename.split('/')[-1]}\"...")
 
-    star_df = read_star(filename)
+    # only the header is read until the columns are checked
+    star_df = scan_header(filename)
 
     # check if the starfile is for micrographs, or particles, but not both
     match star_df:
@@ -80,8 +85,7 @@ def load_data(filename, data_column_x, data_column_y):
             click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} unknown star file type.")
             exit()
 
-    star_df = star_df[star_file_type].to_pandas()
-    valid_data_columns = star_df.columns.tolist()
+    valid_data_columns = star_df[star_file_type]
 
     # print the data columns in the star file and quit
     if data_column_x == "list" or data_column_y == "list":
@@ -91,25 +95,33 @@ def load_data(filename, data_column_x, data_column_y):
         exit()
 
     # catches bad column names
-    elif data_column_x not in valid_data_columns or data_column_x not in valid_data_columns:
-        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} \"{data_column_x}\" is not a valid column name in \"{filename.split('/')[-1]}\"")
+    elif data_column_x not in valid_data_columns or data_column_y not in valid_data_columns:
+        bad_column = data_column_x if data_column_x not in valid_data_columns else data_column_y
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} \"{bad_column}\" is not a valid column name in \"{filename.split('/')[-1]}\"")
         click.echo("\n  The following are valid \"x\" and \"y\" data_column names:")
         for item in valid_data_columns:
             print(f"   {item}")
         exit()
 
-    # make a dataframe of only what is needed
+    # parse only what is needed, in compact dtypes
+    columns = [data_column_x, data_column_y]
     if star_file_type == 'particles':
-        data = star_df[['rlnClassNumber', data_column_x, data_column_y]]
-    elif star_file_type == 'micrographs':
-        data = star_df[[data_column_x, data_column_y]]
+        columns = ['rlnClassNumber'] + columns
+    data = read_columns(filename, star_file_type, columns, {'rlnClassNumber': 'int32', data_column_x: 'float32', data_column_y: 'float32'})
 
     return data, star_file_type, data_column_x, data_column_y
 
 
-def histogram2d(df, data_column_x, data_column_y, gridsize, classes, star_file_type):
+def histogram2d(df, data_column_x, data_column_y, gridsize, classes, star_file_type, engine='raster'):
     fig, ax = plt.subplots(1, 1, sharex=True, tight_layout=True)
-    hb = ax.hexbin(df[data_column_x], df[data_column_y], bins='log', gridsize=gridsize)
+    if engine == 'hexbin':
+        hb = ax.hexbin(df[data_column_x], df[data_column_y], bins='log', gridsize=gridsize)
+    else:
+        # count on a regular grid, then draw the counts as one image
+        x = df[data_column_x].to_numpy(np.float32)
+        y = df[data_column_y].to_numpy(np.float32)
+        x_edges, y_edges = grid_edges(x, gridsize), grid_edges(y, gridsize)
+        hb = draw_counts(ax, grid_counts(x, y, x_edges, y_edges), x_edges, y_edges)
 
     if classes is not None:
         ax.set_title(f"Class {', '.join(str(x) for x in classes)}: {data_column_x} vs. {data_column_y}")
@@ -129,6 +141,20 @@ def histogram2d(df, data_column_x, data_column_y, gridsize, classes, star_file_t
     return fig
 
 
+def count_by_class(df, data_column_x, data_column_y, gridsize, classes):
+    """
+    Counts every class on one shared grid with a single bincount.
+    Returns the (class x x-bin x y-bin) counts and the x and y edges.
+    """
+    x = df[data_column_x].to_numpy(np.float32)
+    y = df[data_column_y].to_numpy(np.float32)
+    x_edges, y_edges = grid_edges(x, gridsize), grid_edges(y, gridsize)
+
+    codes = class_codes(df['rlnClassNumber'].to_numpy(), classes)
+    counts = grouped_counts(codes, len(classes), [bin_index(x, x_edges), bin_index(y, y_edges)], (gridsize, gridsize))
+    return counts, x_edges, y_edges
+
+
 def histogram2d_by_class(df, data_column_x, data_column_y, gridsize, classes, star_file_type):
     fig, axs = plt.subplots(len(classes), 1, sharex=True, sharey=True, tight_layout=True)
 
@@ -136,11 +162,10 @@ def histogram2d_by_class(df, data_column_x, data_column_y, gridsize, classes, st
     if len(classes) == 1:  # or not by_class:
         axs = [axs]
 
-    # Plot a histogram for each class
-    for ax, class_number in zip(axs, classes):
-        filter = df['rlnClassNumber'] == class_number
-        class_data = df[filter]
-        hb = ax.hexbin(class_data[data_column_x], class_data[data_column_y], bins='log', gridsize=gridsize)
+    # Count all classes at once, then plot a slice for each class
+    counts, x_edges, y_edges = count_by_class(df, data_column_x, data_column_y, gridsize, classes)
+    for ax, class_number, class_counts in zip(axs, classes, counts):
+        hb = draw_counts(ax, class_counts, x_edges, y_edges, class_counts.max())
         ax.set_title(f'Class {class_number}: {data_column_x} vs. {data_column_y}')
         ax.set_ylabel(f"{data_column_y}")
         divider = make_axes_locatable(ax)
@@ -176,22 +201,10 @@ def validate_extension(path, extension):
         raise ValueError()
 
 
-@click.command(no_args_is_help=True)
-@click.option('--i', '--input', 'input_file', required=True, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
-@click.option('--x', '--data_x', 'data_column_x', show_default=False, type=str, help="RELION data column to plot on x. Default is 'rlnAngleRot' (particles) or 'rlnCtfIceRingDensity' (micrographs). \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
-@click.option('--y', '--data_y', 'data_column_y', show_default=False, type=str, help="RELION data column to plot on y. Default is 'rlnAngleTilt' (particles) or 'rlnCtfMaxResolution' (micrographs). \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
-@click.option('--by_class', is_flag=True, help="Split by class.")
-@click.option('--c', '--classes', 'classes', multiple=True, help="Specify which class to plot. You can specify multiple. Ignored for micrograph star files.", metavar='<class number>')
-@click.option('--o', '--output', 'out', is_flag=False, flag_value="histogram_output.pdf", help="Optional name for the output file.", metavar='<output.pdf>')
-def cli(input_file, data_column_x, data_column_y, classes, by_class, out):
+def detect_healpix_order(input_file):
     """
-    Plots a 2D histogram.
-    Defaults to Euler Angles Orientation plots.
+    Reads --healpix_order from the latest *_optimiser.star next to the input. None if it is not found.
     """
-
-    # Validate the inputs
-    input_file = validate_extension(input_file, '.star')
-    # try to automatically set the gridsize
     try:
         model_files = get_file_paths(input_file, "_optimiser.star")
         model_file = model_files[-1]  # gets latest file
@@ -204,14 +217,61 @@ def cli(input_file, data_column_x, data_column_y, classes, by_class, out):
                         index = parts.index('--healpix_order')
                         # The value should be the next item in the list
                         if index + 1 < len(parts):
-                            healpix_order = int(parts[index + 1])
-                        break
-        if healpix_order <= 2:
-            gridsize = 25
-        else:
-            gridsize = 50
-    except:
-        gridsize = 50
+                            return int(parts[index + 1])
+    except (IndexError, OSError, ValueError):
+        pass
+    return None
+
+
+def orientation_counts(df, healpix_order, classes):
+    """
+    Bins rlnAngleRot/rlnAngleTilt into NESTED HEALPix pixels and counts them per class with one bincount.
+    Returns (class x pixel) counts. The pixels have equal area, so the counts are the orientation density.
+    """
+    nside = 2**healpix_order
+    npix = hp.nside2npix(nside)
+    # same pose convention as rebalance
+    phi = np.radians(df['rlnAngleRot'].to_numpy() + 180)
+    theta = np.radians(df['rlnAngleTilt'].to_numpy())
+    pixels = hp.ang2pix(nside, theta, phi, nest=True)
+
+    codes = class_codes(df['rlnClassNumber'].to_numpy(), classes)
+    return grouped_counts(codes, len(classes), [pixels], (npix,))
+
+
+def orientation_map(df, healpix_order, classes, by_class):
+    """
+    Plots the orientation density as Mollweide HEALPix maps, one for all classes or one per class.
+    """
+    counts = orientation_counts(df, healpix_order, classes)
+    if by_class:
+        titles = [f'Class {class_number}: views' for class_number in classes]
+    else:
+        counts = counts.sum(axis=0, keepdims=True)
+        titles = [f"Class {', '.join(str(x) for x in classes)}: views"]
+
+    fig = plt.figure(figsize=(6, 4 * len(counts)))
+    for n, (title, pixel_counts) in enumerate(zip(titles, counts)):
+        # empty pixels are grey
+        sky = np.where(pixel_counts > 0, pixel_counts, hp.UNSEEN).astype(float)
+        hp.mollview(sky, fig=fig.number, sub=(len(counts), 1, n + 1), nest=True, norm='log',
+                    title=f"{title} (HEALPix order {healpix_order})", unit='Particles')
+    return fig
+
+
+def make_figure(input_file, data_column_x, data_column_y, classes, by_class, engine='raster', healpix=False, healpix_order=None):
+    """
+    Reads one STAR file and plots its 2D histogram, or its HEALPix orientation map.
+    """
+    # Validate the inputs
+    input_file = validate_extension(input_file, '.star')
+    # try to automatically set the gridsize
+    detected_order = detect_healpix_order(input_file)
+    gridsize = 50 if detected_order is None else gridsize_for_order(detected_order)
+
+    # the views are always binned from the particle angles
+    if healpix:
+        data_column_x, data_column_y = 'rlnAngleRot', 'rlnAngleTilt'
 
     #data = load_data(input_file, data_column_x, data_column_y)
     data, star_file_type, data_column_x, data_column_y = load_data(input_file, data_column_x, data_column_y)
@@ -233,18 +293,65 @@ def cli(input_file, data_column_x, data_column_y, classes, by_class, out):
         classes = None
         by_class = None
 
+    if healpix:
+        if star_file_type != 'particles':
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} --healpix needs a particles star file.")
+            exit()
+        if healpix_order is None:
+            healpix_order = 2 if detected_order is None else detected_order
+        click.echo(f"  Plotting views at HEALPix order {healpix_order}...")
+        return orientation_map(data, healpix_order, classes, by_class)
+
     if by_class:
         click.echo("  Plotting data by class...")
-        histogram2d_by_class(data, data_column_x, data_column_y, gridsize, classes, star_file_type)
+        return histogram2d_by_class(data, data_column_x, data_column_y, gridsize, classes, star_file_type)
     else:
         click.echo("  Plotting data.")
-        histogram2d(data, data_column_x, data_column_y, gridsize, classes, star_file_type)
+        return histogram2d(data, data_column_x, data_column_y, gridsize, classes, star_file_type, engine)
+
+
+@click.command(no_args_is_help=True)
+@click.option('--i', '--input', 'input_file', required=False, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
+@click.option('--x', '--data_x', 'data_column_x', show_default=False, type=str, help="RELION data column to plot on x. Default is 'rlnAngleRot' (particles) or 'rlnCtfIceRingDensity' (micrographs). \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
+@click.option('--y', '--data_y', 'data_column_y', show_default=False, type=str, help="RELION data column to plot on y. Default is 'rlnAngleTilt' (particles) or 'rlnCtfMaxResolution' (micrographs). \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
+@click.option('--by_class', is_flag=True, help="Split by class.")
+@click.option('--c', '--classes', 'classes', multiple=True, help="Specify which class to plot. You can specify multiple. Ignored for micrograph star files.", metavar='<class number>')
+@click.option('--engine', 'engine', type=click.Choice(['raster', 'hexbin']), default='raster', show_default=True, help="'raster' counts on a regular grid and draws one image, so plots stay small. --by_class always uses 'raster'.")
+@click.option('--healpix', is_flag=True, help="Plot the view density of the particles on a HEALPix Mollweide map instead. Ignores --x and --y.")
+@click.option('--k', '--healpix_order', 'healpix_order', type=click.IntRange(0, 10), help="HEALPix order for --healpix. Defaults to the order in *_optimiser.star, or 2.", metavar='<order>')
+@click.option('--o', '--output', 'out', is_flag=False, flag_value="histogram_output.pdf", help="Optional name for the output file.", metavar='<output.pdf>')
+@click.option('--batch', 'batch', multiple=True, help="Run headless on every .star file matching this path or glob, writing one plot per file. Can be passed multiple times.", metavar='<"*.star">')
+@click.option('--format', 'fmt', type=click.Choice(['pdf', 'png']), default='pdf', show_default=True, help="Plot format for --batch.")
+@click.option('--dpi', 'dpi', type=int, default=300, show_default=True, help="Resolution of the saved plots.")
+@click.option('--w', '--workers', 'workers', type=int, help="Number of files to plot at once with --batch.", metavar='<n>')
+def cli(input_file, data_column_x, data_column_y, classes, by_class, engine, healpix, healpix_order, out, batch, fmt, dpi, workers):
+    """
+    Plots a 2D histogram.
+    Defaults to Euler Angles Orientation plots.
+    """
+
+    plot_options = {'data_column_x': data_column_x, 'data_column_y': data_column_y, 'classes': classes, 'by_class': by_class, 'engine': engine,
+                    'healpix': healpix, 'healpix_order': healpix_order}
+
+    if batch and input_file is not None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Pass either '--i' or '--batch', not both.")
+        exit()
+
+    # headless, one plot per file, never shown
+    if batch:
+        run_batch(save_figure, expand_inputs(batch), workers, make_figure=make_figure, suffix='histogram2d', fmt=fmt, dpi=dpi, **plot_options)
+        return
+
+    if input_file is None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing option '--i' (or '--batch').")
+        exit()
+
+    make_figure(input_file, **plot_options)
 
     # Save if out specified, else plot
     if out:
         # histogram.figsize = (11.80, 8.85)
-        # histogram.dpi = 300
-        plt.savefig(out)
+        plt.savefig(out, dpi=dpi)
         plt.show()
     else:
         plt.show()
@@ -1,15 +1,31 @@
-from os import listdir as os_listdir, path as os_path
-from starfile import read as starfile_read
+from os import cpu_count as os_cpu_count, listdir as os_listdir, path as os_path, stat as os_stat
 import matplotlib.pyplot as plt
 import pandas as pd
-from itertools import cycle as itertools_cycle
+from itertools import cycle as itertools_cycle, repeat as itertools_repeat
 import numpy as np
 from re import search as re_search
 import click
 import concurrent.futures
+from multiprocessing import shared_memory
 import time
+import json
+from sqdtools.scripts.batch import expand_inputs, run_batch, use_headless_backend
 
 benchmark = False
+CACHE_NAME = '.sqdt_plot_assign_cache.json'
+BACKENDS = ('serial', 'thread', 'process')
+# below this many files, or on few cores, starting processes costs more than the reads they save
+PROCESS_MIN_FILES = 256
+PROCESS_MIN_CORES = 8
+
+# metric -> (file of the iteration, table). model_classes metrics have one value per class.
+METRICS = {
+    'rlnClassDistribution': ('_model.star', 'model_classes'),
+    'rlnAccuracyRotations': ('_model.star', 'model_classes'),
+    'rlnAccuracyTranslationsAngst': ('_model.star', 'model_classes'),
+    'rlnEstimatedResolution': ('_model.star', 'model_classes'),
+    'rlnChangesOptimalClasses': ('_optimiser.star', 'optimiser_general'),
+}
 
 
 def how_long(process: str, benchmark: bool):
@@ -37,36 +53,286 @@ def get_file_paths(dir, suffix) -> list[str]:
     return rel_filtered_paths
 
 
-def get_column(file, from_table='model_classes', column='rlnClassDistribution') -> list:
-    """ Gets reads and gets the specified column"""
-    file_data = starfile_read(file, read_n_blocks=2)
-    data = file_data[from_table][column].tolist()
+def read_loop_columns(file, from_table='model_classes', columns=('rlnClassDistribution',)) -> dict[str, list[float]]:
+    """
+    Reads some columns of one loop straight from the text. Skips to 'data_<from_table>', finds the labels' indexes,
+    parses only those tokens of each row, and stops reading at the end of the loop.
+    """
+    with open(file, 'r') as f:
+        # Skip to the block
+        for line in f:
+            if line.strip() == f'data_{from_table}':
+                break
+        else:
+            raise KeyError(f"No 'data_{from_table}' in \"{file}\".")
+
+        labels, indexes = [], None
+        data = {column: [] for column in columns}
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#') or stripped == 'loop_':
+                # a blank line after the rows ends the loop
+                if indexes:
+                    break
+            elif stripped.startswith('_'):
+                labels.append(stripped.split()[0].removeprefix('_'))
+            elif stripped.startswith('data_'):
+                break
+            else:
+                if indexes is None:
+                    missing = [column for column in columns if column not in labels]
+                    if missing:
+                        raise KeyError(f"No {', '.join(missing)} in 'data_{from_table}' of \"{file}\".")
+                    indexes = [labels.index(column) for column in columns]
+                tokens = stripped.split()
+                for column, index in zip(columns, indexes):
+                    data[column].append(float(tokens[index]))
+    return data
+
+
+def read_block_values(file, from_table='optimiser_general', keys=('rlnChangesOptimalClasses',)) -> dict[str, float]:
+    """
+    Reads some values of a block that is not a loop ('_rlnKey value' lines), and stops at the end of the block.
+    """
+    values = {}
+    with open(file, 'r') as f:
+        in_block = False
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith('data_'):
+                if in_block:
+                    break
+                in_block = stripped == f'data_{from_table}'
+            elif in_block and stripped.startswith('_'):
+                parts = stripped.split()
+                key = parts[0].removeprefix('_')
+                if key in keys and len(parts) > 1:
+                    values[key] = float(parts[1])
+                    if len(values) == len(keys):
+                        break
+
+    missing = [key for key in keys if key not in values]
+    if missing:
+        raise KeyError(f"No {', '.join(missing)} in 'data_{from_table}' of \"{file}\".")
+    return values
+
+
+def read_metrics(model_file, metrics) -> dict[str, list[float]]:
+    """
+    Reads every metric of one iteration, with one read of its _model.star and one of its _optimiser.star.
+    Metrics of a block that is not a loop come back as a list of one value.
+    """
+    data = {}
+    for suffix in dict.fromkeys(METRICS[metric][0] for metric in metrics):
+        file = model_file.removesuffix('_model.star') + suffix
+        for table in dict.fromkeys(METRICS[metric][1] for metric in metrics if METRICS[metric][0] == suffix):
+            columns = tuple(metric for metric in metrics if METRICS[metric] == (suffix, table))
+            if table == 'optimiser_general':
+                data.update({key: [value] for key, value in read_block_values(file, table, columns).items()})
+            else:
+                data.update(read_loop_columns(file, table, columns))
     return data
 
 
-@how_long("Usual DF", benchmark)
-def merge_columns(file_paths, from_table='model_classes', column='rlnClassDistribution') -> pd.DataFrame:
-    data = []
-    for file in file_paths:
-        row = get_column(file, from_table, column)
-        data.append(row)
-    df = pd.DataFrame(data)
-    df.columns = [f'Class {i + 1}' for i in range(len(df.transpose()))]
-    return df
+def load_cache(folder) -> dict:
+    """
+    Reads the sidecar cache of a job folder. An unreadable cache is treated as empty.
+    """
+    try:
+        with open(os_path.join(folder, CACHE_NAME), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(folder, cache):
+    """
+    Writes the sidecar cache. A folder that is not writable only loses the cache.
+    """
+    try:
+        with open(os_path.join(folder, CACHE_NAME), 'w') as file:
+            json.dump(cache, file)
+    except OSError:
+        click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} Could not write the cache to \"{folder}\".")
+
+
+def pick_backend(n_files, backend='auto', workers=None) -> tuple[str, int]:
+    """
+    Picks how to read the model files. Reading one is a short scan of a few KB, so threads win unless
+    there are very many files and many cores, and a single core reads serially. Workers default to one per core, at most one per file.
+    """
+    cores = os_cpu_count() or 1
+    if backend == 'auto':
+        if cores == 1 or n_files == 1:
+            backend = 'serial'
+        elif n_files >= PROCESS_MIN_FILES and cores >= PROCESS_MIN_CORES:
+            backend = 'process'
+        else:
+            backend = 'thread'
+    if backend == 'serial':
+        workers = 1
+    elif workers is None:
+        workers = max(1, min(cores, n_files))
+    return backend, workers
+
+
+def fill_row(file, row, metrics, arrays):
+    """
+    Reads the metrics of one iteration straight into its row of the preallocated arrays.
+    """
+    for metric, values in read_metrics(file, metrics).items():
+        arrays[metric][row] = values
+
+
+def fill_row_shared(file, row, metrics, shared):
+    """
+    fill_row for worker processes. The arrays live in shared memory, so nothing is sent back to the parent.
+    shared is {metric: (shared memory name, shape)}.
+    """
+    blocks = {metric: shared_memory.SharedMemory(name) for metric, (name, _) in shared.items()}
+    try:
+        arrays = {metric: np.ndarray(shared[metric][1], dtype=np.float64, buffer=block.buf) for metric, block in blocks.items()}
+        fill_row(file, row, metrics, arrays)
+        del arrays
+    finally:
+        for block in blocks.values():
+            block.close()
+
+
+def make_executor(backend, workers):
+    """
+    Starts the pool for a backend, or None to read serially.
+    """
+    if backend == 'process':
+        return concurrent.futures.ProcessPoolExecutor(workers)
+    if backend == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    return None
+
+
+def fill_rows(file_paths, rows, metrics, arrays, backend='thread', workers=None, exe=None):
+    """
+    Reads every metric of the files straight into the given rows of preallocated (iterations x classes) arrays.
+    Pass exe to share one pool between calls.
+    """
+    own_exe = exe is None and bool(file_paths)
+    if own_exe:
+        exe = make_executor(backend, workers)
+
+    try:
+        if backend == 'process' and file_paths:
+            blocks = {metric: shared_memory.SharedMemory(create=True, size=max(arrays[metric].nbytes, 1)) for metric in metrics}
+            try:
+                shared = {metric: (block.name, arrays[metric].shape) for metric, block in blocks.items()}
+                list(exe.map(fill_row_shared, file_paths, rows, itertools_repeat(metrics), itertools_repeat(shared), chunksize=max(1, len(file_paths) // (4 * (workers or 1)))))
+                # only the rows read are copied out, so the shared memory can be freed
+                for metric, block in blocks.items():
+                    arrays[metric][rows] = np.ndarray(arrays[metric].shape, dtype=np.float64, buffer=block.buf)[rows]
+            finally:
+                for block in blocks.values():
+                    block.close()
+                    block.unlink()
+        elif backend == 'thread' and file_paths:
+            list(exe.map(fill_row, file_paths, rows, itertools_repeat(metrics), itertools_repeat(arrays)))
+        else:
+            for file, row in zip(file_paths, rows):
+                fill_row(file, row, metrics, arrays)
+    finally:
+        if own_exe and exe is not None:
+            exe.shutdown()
+
+
+def read_into_arrays(file_paths, metrics, backend='thread', workers=None, exe=None) -> dict[str, np.ndarray]:
+    """
+    Reads every metric of every file into one preallocated (iterations x classes) array per metric.
+    The first file is read first, to size the arrays. Pass exe to share one pool between calls.
+    """
+    first = read_metrics(file_paths[0], metrics)
+    arrays = {metric: np.empty((len(file_paths), len(first[metric]))) for metric in metrics}
+    for metric in metrics:
+        arrays[metric][0] = first[metric]
+    fill_rows(file_paths[1:], list(range(1, len(file_paths))), metrics, arrays, backend, workers, exe)
+    return arrays
+
+
+def benchmark_backends(file_paths, metrics, workers=None):
+    """
+    Times reading every file with each backend, without the cache, and reports the speedup over serial.
+    """
+    click.echo(f"  Benchmarking {len(file_paths)} model files on {os_cpu_count()} cores...")
+    times = {}
+    for backend in BACKENDS:
+        backend, n_workers = pick_backend(len(file_paths), backend, workers)
+        start = time.perf_counter()
+        read_into_arrays(file_paths, metrics, backend, n_workers)
+        times[backend] = time.perf_counter() - start
+        click.echo(f"    {backend:>8} ({n_workers} workers): {times[backend]:.4f} s, {times['serial'] / times[backend]:.2f}x serial")
+    click.echo(f"    auto picks '{pick_backend(len(file_paths), 'auto', workers)[0]}'.")
+
+
+@how_long("Cached DF", benchmark)
+def cached_metrics(folder, file_paths, metrics=('rlnClassDistribution',), backend='auto', workers=None, exe=None) -> dict[str, pd.DataFrame]:
+    """
+    Reads every metric of every iteration, keeping them in a sidecar cache keyed by model file name, size and mtime.
+    Only new or changed iterations are parsed, each with a single read per file. Returns {metric: (iterations x classes) DataFrame}.
+    A shared pool can be passed as exe, together with its backend and workers.
+    """
+    cache = load_cache(folder)
+    stats = {file: os_stat(file) for file in file_paths}
+
+    def is_fresh(file):
+        entry = cache.get(os_path.basename(file))
+        return entry is not None and all(metric in entry for metric in metrics) and entry['size'] == stats[file].st_size and entry['mtime'] == stats[file].st_mtime_ns
+
+    fresh = [is_fresh(file) for file in file_paths]
+    stale_rows = [row for row, is_cached in enumerate(fresh) if not is_cached]
+    fresh_rows = [row for row, is_cached in enumerate(fresh) if is_cached]
+
+    # one (iterations x classes) array per metric for every iteration, sized from a cached iteration or the first stale one
+    if fresh_rows:
+        sized = cache[os_path.basename(file_paths[fresh_rows[0]])]
+        read_rows = stale_rows
+    else:
+        sized = read_metrics(file_paths[stale_rows[0]], metrics)
+        read_rows = stale_rows[1:]
+    arrays = {metric: np.empty((len(file_paths), len(sized[metric]))) for metric in metrics}
+    if not fresh_rows:
+        for metric in metrics:
+            arrays[metric][stale_rows[0]] = sized[metric]
+
+    for row in fresh_rows:
+        entry = cache[os_path.basename(file_paths[row])]
+        for metric in metrics:
+            arrays[metric][row] = entry[metric]
+
+    if stale_rows:
+        if exe is None:
+            backend, workers = pick_backend(len(stale_rows), backend, workers)
+        click.echo(f"  Reading {len(stale_rows)} new model files ({len(fresh_rows)} cached), {workers} {backend} workers...")
+        # the stale rows are written in place by the workers
+        fill_rows([file_paths[row] for row in read_rows], read_rows, metrics, arrays, backend, workers, exe)
+        for row in stale_rows:
+            # a changed file drops everything cached for it
+            file = file_paths[row]
+            entry = cache.get(os_path.basename(file), {})
+            if (entry.get('size'), entry.get('mtime')) != (stats[file].st_size, stats[file].st_mtime_ns):
+                entry = {'size': stats[file].st_size, 'mtime': stats[file].st_mtime_ns}
+            entry.update({metric: arrays[metric][row].tolist() for metric in metrics})
+            cache[os_path.basename(file)] = entry
+        save_cache(folder, cache)
+
+    return {metric: pd.DataFrame(array, columns=[f'Class {i + 1}' for i in range(array.shape[1])], copy=False) for metric, array in arrays.items()}
 
 
-@how_long("Concurrent DF", benchmark)
-def concurrent_merge_columns(file_paths, from_table='model_classes', column='rlnClassDistribution', threads=None) -> pd.DataFrame:
-    with concurrent.futures.ProcessPoolExecutor(threads) as exe:
-        # futures = [exe.submit(process, file) for file in files]
-        futures = exe.map(get_column, file_paths)
-    df = pd.DataFrame(list(futures))
-    df.columns = [f'Class {i + 1}' for i in range(len(df.transpose()))]
-    return df
+def get_iteration(file) -> str:
+    """
+    Gets the iteration of a model file from its name only, so folders with 'it' in their path do not match.
+    """
+    return re_search(r'_it(\d+)_model\.star$', os_path.basename(file)).group(1)
 
 
 def get_max_iteration(file_list) -> str and int:
-    n = re_search('it(.*)_model', file_list[-1]).group(1)  # Extracts value between 'it' & '_model'
+    n = get_iteration(file_list[-1])
     return n, int(n)
 
 
@@ -81,61 +347,275 @@ def dir_not_cleaned(file_list) -> bool:
     return highest_iter_set == files_len_set
 
 
-@click.command(no_args_is_help=True)
-@click.argument('folder', type=click.Path(exists=True))
-@click.option('--o', '--output', 'out', help="Optional name for the output file.", metavar='<output.pdf>')
-@click.option('--ns', '--no_save', 'suppress_out', flag_value=True, help="Do not save the plot.")
-@click.option('--b', '--benchmark', 'benchmark', flag_value=True, help="Do not save the plot.")
-def cli(folder, out, suppress_out, benchmark):
+def output_prefix(metrics) -> str:
     """
-    Script for plotting 3D class asignments against iteration from RELIONs '_model.star' file.
+    Names the plot after what it shows: class proportions alone, or the convergence dashboard.
+    """
+    return '3Dproportions' if list(metrics) == ['rlnClassDistribution'] else '3Dconvergence'
+
+
+def draw_metric(ax, df, metric):
+    """
+    Draws one metric against iteration, one line per class.
     """
+    marker = itertools_cycle(('|', 'x', '*', 's', 'o', 'v'))
+    for class_number in df:
+        ax.plot(df[class_number], linewidth=0.75, marker=next(marker), markerfacecolor='none', markeredgewidth=0.75, markersize=4)
+    ax.set_xlabel('Iteration')
+    ax.set_ylabel(metric)
+    ax.set_xticks(np.arange(0, len(df), 5))
+    ax.set_xlim(0, max(len(df) - 1, 1))
 
+
+def plot_folder(folder, out, suppress_out, fmt='pdf', dpi=300, headless=False, metrics=('rlnClassDistribution',), backend='auto', workers=None):
+    """
+    Plots the class assignments of one job folder, or a grid of convergence metrics. Returns the saved file,
+    or None if it was not saved. Headless runs never show the plot.
+    """
     job_number = os_path.basename(os_path.abspath(folder))
-    data_column = 'rlnClassDistribution'  # Hard coded
     suffix = '_model.star'  # Hard coded
 
     # Get file list
     model_files = get_file_paths(folder, suffix)
 
-    # # Get the data the usual way
-    # df = merge_columns(model_files)
-    # Get the data with concurrency, this is slightly faster
-    df = concurrent_merge_columns(model_files, threads=5)
+    # Only parse the iterations that are not in the cache yet, every metric from one read of each file
+    dfs = cached_metrics(folder, model_files, tuple(metrics), backend, workers)
 
     # Prepare the plots and make them pretty.
-    marker = itertools_cycle(('|', 'x', '*', 's', 'o', 'v'))
-    for class_number in df:
-        plt.plot(df[class_number], linewidth=0.75, marker=next(marker), markerfacecolor='none', markeredgewidth=0.75, markersize=4)
-    plt.xlabel('Iteration')
-    plt.ylabel(data_column)
-    plt.xticks(np.arange(0, len(df), 5))
-    plt.xlim(0, len(df) - 1)
-    plt.legend([f'Class {i + 1}' for i in range(len(df))], loc='upper left', frameon=False, bbox_to_anchor=(1.00, 1))
-    plt.title(f"3D Classification - {job_number}")
-    plt.tight_layout(rect=[0, 0, 1, 1])
+    if len(metrics) == 1:
+        fig, ax = plt.subplots()
+        axs = [ax]
+    else:
+        n_rows = (len(metrics) + 1) // 2
+        fig, axs = plt.subplots(n_rows, 2, sharex=True, figsize=(10, 2.75 * n_rows), squeeze=False)
+        axs = axs.ravel()
+        for ax in axs[len(metrics):]:
+            ax.set_visible(False)
+
+    for ax, metric in zip(axs, metrics):
+        draw_metric(ax, dfs[metric], metric)
+
+    # one legend for the classes, from the first metric with one line per class
+    per_class = [(ax, metric) for ax, metric in zip(axs, metrics) if dfs[metric].shape[1] > 1]
+    if len(metrics) == 1:
+        if per_class:
+            axs[0].legend(dfs[metrics[0]].columns.tolist(), loc='upper left', frameon=False, bbox_to_anchor=(1.00, 1))
+        axs[0].set_title(f"3D Classification - {job_number}")
+        fig.tight_layout(rect=[0, 0, 1, 1])
+    else:
+        if per_class:
+            ax, metric = per_class[0]
+            fig.legend(ax.get_lines(), dfs[metric].columns.tolist(), loc='upper right', frameon=False)
+        fig.suptitle(f"3D Classification - {job_number}")
+        fig.tight_layout(rect=[0, 0, 0.88, 1])
 
     # Set the output name if user does not provide value
     if not out:
         max_iteration, _ = get_max_iteration(model_files)
-        out = f"3Dproportions_{job_number}_it{max_iteration}.pdf"
+        out = f"{output_prefix(metrics)}_{job_number}_it{max_iteration}.{fmt}"
 
     # Check for cleaned directory to prevent overwriting
     if dir_not_cleaned(model_files) and not suppress_out:
         try:
             # histogrsam.figsize = (11.80, 8.85)
-            # histogram.dpi = 300
-            plt.savefig(out)
+            plt.savefig(out, dpi=dpi)
         except IOError:  # could also be IOError
             click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} Did not save. Is this directory writable?")
-        finally:
-            plt.show()
+            out = None
     elif not dir_not_cleaned(model_files):
         click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} Did not save. Intermediate files are missing. Did you gently clean this directory?")
-        plt.show()
+        out = None
+    else:
+        out = None
+
+    if headless:
+        plt.close(fig)
     else:
         plt.show()
 
+    return out
+
+
+def long_table(dfs, model_files, metric) -> pd.DataFrame:
+    """
+    Stacks the (iterations x classes) tables of several jobs into one long table: job, iteration, class, value.
+    The value column is 'fraction' for rlnClassDistribution, and the metric's name otherwise.
+    """
+    value_column = 'fraction' if metric == 'rlnClassDistribution' else metric
+    tables = []
+    for job, df in dfs.items():
+        iterations = [int(get_iteration(file)) for file in model_files[job]]
+        n_iterations, n_classes = df.shape
+        tables.append(pd.DataFrame({
+            'job': job,
+            'iteration': np.repeat(iterations, n_classes),
+            'class': np.tile(np.arange(1, n_classes + 1), n_iterations),
+            value_column: df.to_numpy().ravel(),
+        }))
+    return pd.concat(tables, ignore_index=True)
+
+
+def export_table(table, filename):
+    """
+    Writes the long table as .csv, or as .parquet, which needs pyarrow or fastparquet.
+    """
+    if filename.endswith('.parquet'):
+        try:
+            table.to_parquet(filename, index=False)
+        except ImportError:
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Writing Parquet needs pyarrow or fastparquet. Use --export csv instead.")
+            return
+    else:
+        table.to_csv(filename, index=False)
+    click.echo(f"  Wrote {len(table):,} rows to \"{filename}\".")
+
+
+def compare_folders(folders, out, suppress_out, fmt='pdf', dpi=300, metric='rlnClassDistribution', layout='subplots', export=None, backend='auto', workers=None):
+    """
+    Compares one metric across several job folders. Every folder's model files are read through one shared pool,
+    then drawn as aligned subplots or as one overlay, and optionally exported as one long table.
+    """
+    # the folder name, or the path if two folders share a name
+    names = [os_path.basename(os_path.abspath(folder)) for folder in folders]
+    jobs = [name if names.count(name) == 1 else folder.rstrip('/') for name, folder in zip(names, folders)]
+    model_files = {job: get_file_paths(folder, '_model.star') for job, folder in zip(jobs, folders)}
+    empty = [job for job in jobs if not model_files[job]]
+    if empty:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} No '_model.star' files in {', '.join(empty)}.")
+        exit()
+
+    # one pool for every folder, sized by all of their files
+    backend, workers = pick_backend(sum(len(files) for files in model_files.values()), backend, workers)
+    exe = make_executor(backend, workers)
+    try:
+        dfs = {job: cached_metrics(folder, model_files[job], (metric,), backend, workers, exe)[metric] for job, folder in zip(jobs, folders)}
+    finally:
+        if exe is not None:
+            exe.shutdown()
+
+    if layout == 'overlay':
+        # one colour per job, one marker per class
+        fig, ax = plt.subplots(figsize=(8, 4.5))
+        colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        for color, (job, df) in zip(itertools_cycle(colors), dfs.items()):
+            marker = itertools_cycle(('|', 'x', '*', 's', 'o', 'v'))
+            for n, class_number in enumerate(df):
+                ax.plot(df[class_number], color=color, linewidth=0.75, marker=next(marker), markerfacecolor='none', markeredgewidth=0.75, markersize=4, label=job if n == 0 else None)
+        ax.set_xlabel('Iteration')
+        ax.set_ylabel(metric)
+        ax.set_xlim(0, max(max(len(df) for df in dfs.values()) - 1, 1))
+        ax.legend(loc='upper left', frameon=False, bbox_to_anchor=(1.00, 1))
+        ax.set_title(f"3D Classification - {len(jobs)} jobs")
+    else:
+        # aligned axes, so the trajectories line up by iteration and value
+        fig, axs = plt.subplots(len(jobs), 1, sharex=True, sharey=True, figsize=(8, 2.25 * len(jobs)), squeeze=False)
+        for ax, (job, df) in zip(axs[:, 0], dfs.items()):
+            draw_metric(ax, df, metric)
+            ax.set_title(job)
+            ax.legend(df.columns.tolist(), loc='upper left', frameon=False, bbox_to_anchor=(1.00, 1))
+        ax.set_xlim(0, max(max(len(df) for df in dfs.values()) - 1, 1))
+        fig.suptitle(f"3D Classification - {len(jobs)} jobs")
+    fig.tight_layout()
+
+    if not out:
+        out = f"3Dcompare_{len(jobs)}jobs_{metric}.{fmt}"
+    if not suppress_out:
+        click.echo(f"  Saving the comparison to \"{out}\".")
+        plt.savefig(out, dpi=dpi)
+    if export:
+        export_table(long_table(dfs, model_files, metric), f"{out.rsplit('.', 1)[0]}.{export}")
+
+    plt.show()
+    return out
+
+
+def watch_folder(folder, out, fmt, dpi, interval, metrics=('rlnClassDistribution',), backend='auto', workers=None):
+    """
+    Polls a running job and rewrites the plot in place whenever a model file is added or changed. Stops on Ctrl+C.
+    """
+    use_headless_backend()
+    job_number = os_path.basename(os_path.abspath(folder))
+    out = out or f"{output_prefix(metrics)}_{job_number}.{fmt}"
+    click.echo(f"  Watching \"{folder}\" every {interval} seconds. Press Ctrl+C to stop.")
+
+    last_seen = None
+    try:
+        while True:
+            model_files = get_file_paths(folder, '_model.star')
+            seen = [(file, os_stat(file).st_size, os_stat(file).st_mtime_ns) for file in model_files]
+            if model_files and seen != last_seen:
+                try:
+                    if plot_folder(folder, out, False, fmt, dpi, headless=True, metrics=metrics, backend=backend, workers=workers):
+                        click.echo(f"  Iteration {get_max_iteration(model_files)[1]}: wrote \"{out}\".")
+                    last_seen = seen
+                except Exception as e:
+                    # RELION may still be writing the newest file, try again on the next poll
+                    click.echo(f"  {click.style('WARNING:', fg='red', bold=True)} Could not plot yet: {e!r}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        click.echo("\n  Stopped watching.")
+
+
+@click.command(no_args_is_help=True)
+@click.argument('folders', nargs=-1, type=click.Path(exists=True))
+@click.option('--o', '--output', 'out', help="Optional name for the output file.", metavar='<output.pdf>')
+@click.option('--ns', '--no_save', 'suppress_out', flag_value=True, help="Do not save the plot.")
+@click.option('--b', '--benchmark', 'benchmark', flag_value=True, help="Time reading the model files with each backend before plotting.")
+@click.option('--m', '--metric', 'metrics', multiple=True, type=click.Choice(list(METRICS)), help="Metric to plot against iteration. Pass several for a grid of subplots. Defaults to rlnClassDistribution.")
+@click.option('--dashboard', 'dashboard', is_flag=True, help="Plot every metric.")
+@click.option('--layout', 'layout', type=click.Choice(['subplots', 'overlay']), default='subplots', show_default=True, help="How to compare several folders: aligned subplots, or one overlay.")
+@click.option('--export', 'export', type=click.Choice(['csv', 'parquet']), help="With several folders, also write one long table (job, iteration, class, fraction).")
+@click.option('--watch', 'watch', is_flag=True, help="Keep polling the folder of a running job and rewrite the plot as new iterations appear.")
+@click.option('--interval', 'interval', type=float, default=60, show_default=True, help="Seconds between polls with --watch.", metavar='<seconds>')
+@click.option('--batch', 'batch', multiple=True, help="Run headless on every job folder matching this path or glob, writing one plot per folder. Can be passed multiple times.", metavar='<"Class3D/job*">')
+@click.option('--format', 'fmt', type=click.Choice(['pdf', 'png']), default='pdf', show_default=True, help="Plot format when --o is not given.")
+@click.option('--dpi', 'dpi', type=int, default=300, show_default=True, help="Resolution of the saved plot.")
+@click.option('--backend', 'backend', type=click.Choice(('auto',) + BACKENDS), default='auto', show_default=True, help="How to read the model files. 'auto' picks threads, or processes for very many files on many cores.")
+@click.option('--w', '--workers', 'workers', type=int, help="Number of model files read at once, or of folders plotted at once with --batch. Defaults to the number of cores.", metavar='<n>')
+def cli(folders, out, suppress_out, benchmark, metrics, dashboard, layout, export, watch, interval, batch, fmt, dpi, backend, workers):
+    """
+    Script for plotting 3D class asignments against iteration from RELIONs '_model.star' file.
+    Pass several folders to compare their jobs.
+    """
+
+    if dashboard:
+        metrics = tuple(METRICS)
+    metrics = tuple(dict.fromkeys(metrics)) or ('rlnClassDistribution',)
+
+    if batch and folders:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Pass either FOLDERS or '--batch', not both.")
+        exit()
+
+    # headless, one plot per folder, never shown
+    if batch:
+        # the folders already run in processes, so each reads its files with threads unless told otherwise
+        backend = 'thread' if backend == 'auto' else backend
+        run_batch(plot_folder, expand_inputs(batch), workers, out=None, suppress_out=suppress_out, fmt=fmt, dpi=dpi, headless=True, metrics=metrics, backend=backend)
+        return
+
+    if not folders:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing argument 'FOLDERS' (or '--batch').")
+        exit()
+
+    # several jobs, one metric, one shared pool
+    if len(folders) > 1:
+        if watch or len(metrics) > 1:
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Comparing folders supports one --metric, and not --watch.")
+            exit()
+        compare_folders(folders, out, suppress_out, fmt, dpi, metrics[0], layout, export, backend, workers)
+        return
+
+    folder = folders[0]
+
+    if benchmark:
+        benchmark_backends(get_file_paths(folder, '_model.star'), metrics, workers)
+
+    if watch:
+        watch_folder(folder, out, fmt, dpi, interval, metrics, backend, workers)
+        return
+
+    plot_folder(folder, out, suppress_out, fmt, dpi, metrics=metrics, backend=backend, workers=workers)
+
 
 if __name__ == '__main__':
     cli(max_content_width=120)
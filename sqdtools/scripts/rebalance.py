@@ -1,12 +1,13 @@
 import healpy as hp
 import numpy as np
 import matplotlib.pyplot as plt
-import math
 import starfile
-from itertools import cycle
 import pandas as pd
+from itertools import cycle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import click
+from sqdtools.scripts.batch import expand_inputs, run_batch
+from sqdtools.scripts.binning import draw_counts, grid_counts, gridsize_for_order
 
 
 # def calculate_percentile(bin_edges, bin_counts, percentile):
@@ -58,10 +59,17 @@ import click
 #     return fig
 
 
-def histogram2d(fig, axis, df, data_x, data_y, title, xlabel, ylabel, plot_position=(0, 0), gridsize=50):
+def histogram2d(fig, axis, df, data_x, data_y, title, xlabel, ylabel, plot_position=(0, 0), gridsize=50, engine='raster'):
     grid_y, grid_x = plot_position
     ax = fig.add_subplot(3, grid_y, grid_x)
-    hb = ax.hexbin(df[data_x], df[data_y], bins='log', gridsize=gridsize)  # cmap=colormap, gridsize=gridsize)
+    if engine == 'hexbin':
+        hb = ax.hexbin(df[data_x], df[data_y], bins='log', gridsize=gridsize)  # cmap=colormap, gridsize=gridsize)
+    else:
+        # square bins over the full sphere, drawn as one image
+        x_edges = np.linspace(-180, 180, gridsize + 1)
+        y_edges = np.linspace(0, 180, gridsize // 2 + 1)
+        counts = grid_counts(df[data_x].to_numpy(np.float32), df[data_y].to_numpy(np.float32), x_edges, y_edges)
+        hb = draw_counts(ax, counts, x_edges, y_edges)
     ax.set_title(title)
     # axis.set_title(f"Class {', '.join(str(x) for x in classes)}: {data_column_x} vs. {data_column_y}")
     ax.set_xlabel(xlabel)
@@ -84,48 +92,104 @@ def histogram2d(fig, axis, df, data_x, data_y, title, xlabel, ylabel, plot_posit
 #     return data
 
 
-def dict_from_counts(df, npix, subset='healpix') -> dict:
+MAX_HEALPIX_ORDER = 10
+
+
+def auto_healpix_order(n_particles, occupancy) -> int:
+    """
+    Picks the finest healpix order that still holds about 'occupancy' particles per pixel.
+    """
+    order = int(np.floor(np.log(max(n_particles, 1) / (12 * occupancy)) / np.log(4)))
+    return min(max(order, 0), MAX_HEALPIX_ORDER)
+
+
+def adaptive_bins(pixels, order, occupancy) -> np.ndarray:
     """
-    Turns the dataframe into a dictionary of counts. dict('healpix': 'count')
-    Restores the missing values with zero.
+    Merges sparse NESTED healpix pixels into their parent pixels, one order at a time,
+    until every bin has at least 'occupancy' particles or is at order 0.
+    Pixels are held as NUNIQ ids (4 * 4**order + pixel), so the parent of a bin at any
+    order is its id shifted right by 2, and ang2pix is never recomputed.
+    Returns a dense bin index for every particle.
     """
-    counts_dict = df.value_counts(subset=subset, sort=False).to_dict()
+    uniq = 4 * 4**order + pixels.astype(np.int64)
 
-    # add missing pixels to dictionary
-    missing_pix = {pix: 0 for pix in range(npix) if pix not in counts_dict.keys()}
-    counts_dict.update(missing_pix)
+    for level in range(order, 0, -1):
+        at_level = (uniq >> (2 * level + 2) > 0) & (uniq >> (2 * level + 2) < 4)
+        bins, inverse, counts = np.unique(uniq[at_level], return_inverse=True, return_counts=True)
+        sparse = counts[inverse.ravel()] < occupancy
+        uniq[np.flatnonzero(at_level)[sparse]] >>= 2
 
-    return counts_dict
+    _, dense_bins = np.unique(uniq, return_inverse=True)
+    return dense_bins.ravel()
 
 
-def threshold_counts(counts_dict, percentile):
+def healpix_counts(pixels, npix) -> np.ndarray:
+    """
+    Counts the particles in every healpix pixel, including the empty ones.
+    """
+    return np.bincount(pixels, minlength=npix)
+
+
+def threshold_counts(counts, percentile):
     """
     Returns the counts in the bin, that if thresholded by this count
     will return x percent of the data.
     """
+    # capping the i largest pixels at the (i + 1)th largest count keeps this many particles
+    descending = np.sort(counts)[::-1]
+    total_particles = descending.sum()
+    i = np.arange(1, len(descending))
+    kept = total_particles - np.cumsum(descending)[:-1] + descending[1:] * i
 
-    sorted_counts = list(sorted(counts_dict.values()))
-    total_particles = partial_sum = sum(sorted_counts)
+    below = np.flatnonzero(kept / total_particles < percentile)
+    if len(below) == 0:
+        return descending[0]
 
-    for i, pix_count in enumerate(reversed(sorted_counts), start=1):
-        # sum up to the last bin
-        partial_sum -= pix_count
-        percent = (partial_sum + (sorted_counts[-(i + 1)] * i)) / total_particles
+    return descending[below[0]]
 
-        if percent < percentile:
-            threshold_count = sorted_counts[-(i)]
-            break
 
-    return threshold_count
+def downsample(pixels, counts, threshold_count, seed=None) -> np.ndarray:
+    """
+    Randomly keeps at most threshold_count particles in every healpix pixel.
+    threshold_count is one count for every pixel, or an array with a count for each pixel.
+    Each particle draws one random key, and is kept if its key ranks below the cap within its pixel.
+    Returns a mask of the included particles, the rest are excluded.
+    """
+    keys = np.random.default_rng(seed).random(len(pixels))
+    caps = np.broadcast_to(threshold_count, counts.shape)
 
+    # sort by pixel, then by key, and rank each particle within its pixel
+    order = np.lexsort((keys, pixels))
+    sorted_pixels = pixels[order]
+    starts = np.cumsum(counts) - counts
+    ranks = np.arange(len(pixels)) - starts[sorted_pixels]
+
+    included = np.empty(len(pixels), dtype=bool)
+    included[order] = ranks < caps[sorted_pixels]
+
+    return included
+
+
+def stratum_summary(strata_names, column, counts, included_counts, thresholds) -> pd.DataFrame:
+    """
+    Tabulates the particles in each stratum before and after rebalancing.
+    counts and included_counts are (strata x pixels) arrays.
+    """
+    return pd.DataFrame({
+        column: strata_names,
+        'views': (counts > 0).sum(axis=1),
+        'threshold_count': thresholds,
+        'particles_before': counts.sum(axis=1),
+        'particles_after': included_counts.sum(axis=1),
+        'max_view_before': counts.max(axis=1),
+        'max_view_after': included_counts.max(axis=1)})
 
-@click.command(no_args_is_help=True)
-@click.option('--i', '--input', 'input', required=True, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
-@click.option('--t', '--threshold', 'threshold', required=True, default=0.8, type=float, help="Percent particles to keep.", metavar='0.8')
-@click.option('--ns', '--no_save', 'suppress_out', flag_value=True, help="Analyze only. Do not save the plots or STAR files.")
-@click.option('--p', '--prefix', 'prefix', help="Prefix for the output files.", metavar='<prefix_output.star>')
-def cli(input, prefix, suppress_out, threshold):
 
+def rebalance(input, prefix, suppress_out, threshold, seed, healpix_order, auto_order, adaptive, occupancy, stratify, engine='raster', fmt='pdf', dpi=300, headless=False):
+    """
+    Rebalances the views of one STAR file, and writes the plots and the included and excluded particles.
+    Headless runs never show the plots and prefix the outputs with the input file name.
+    """
     # read in the starfile
     click.echo(f"  Reading \"{input.split('/')[-1]}\".")  # Gets file name from the path
     df = starfile.read(input)
@@ -136,28 +200,33 @@ def cli(input, prefix, suppress_out, threshold):
     data_column_y = 'rlnAngleTilt'
 
     click.echo("\n  Binning by orientation...")
-    # add posese columns that are compatable with healpix
-    particles_df[f"{data_column_x}_RAD"] = particles_df[data_column_x].apply(lambda x: math.radians(x + 180))
-    particles_df[f"{data_column_y}_RAD"] = particles_df[data_column_y].apply(lambda y: math.radians(y))
+    # posese that are compatable with healpix
+    phi = np.radians(particles_df[data_column_x].to_numpy() + 180)
+    theta = np.radians(particles_df[data_column_y].to_numpy())
 
     # healpix settings
-    k = 3
+    k = auto_healpix_order(len(particles_df), occupancy) if auto_order else healpix_order
     nside = 2**k
     npix = hp.nside2npix(nside)
-    theta = particles_df[f"{data_column_y}_RAD"]
-    phi = particles_df[f"{data_column_x}_RAD"]
-    #print(f"There are {npix} pixels")
-    # get a list of healpix indexes: 0 -> npix-1, npix total
-    pixels = hp.ang2pix(nside, theta, phi)
-
-    # add this back to the particles_df
-    particles_df['healpix'] = pixels
-
-    # dictionary of particle counts per healpix -> dict('healpix': 'count')
-    healpix_counts_dict = dict_from_counts(particles_df, npix)
-
-    # map counts of each healpix to each particle
-    particles_df['healpix_counts'] = particles_df['healpix'].map(healpix_counts_dict)
+    click.echo(f"    Using HEALPix order {k} ({npix} pixels).")
+    # get a list of NESTED healpix indexes: 0 -> npix-1, npix total
+    pixels = hp.ang2pix(nside, theta, phi, nest=True)
+
+    # merge sparse pixels into their parents
+    if adaptive:
+        pixels = adaptive_bins(pixels, k, occupancy)
+        npix = pixels.max() + 1
+        click.echo(f"    Merged pixels with fewer than {occupancy} particles into {npix} bins.")
+
+    # combine the stratum and the pixel into one bin, so one bincount counts every stratum
+    if stratify:
+        strata_names, strata = np.unique(particles_df[stratify].to_numpy(), return_inverse=True)
+        click.echo(f"    Stratifying by {stratify}: {len(strata_names)} strata.")
+        pixels = strata.ravel() * npix + pixels
+        npix = len(strata_names) * npix
+
+    # particle counts per healpix, empty pixels included
+    counts = healpix_counts(pixels, npix)
 
     """
     I don't real;y understand how cryosparc is calculating the 'rebalance percentile'
@@ -165,23 +234,26 @@ def cli(input, prefix, suppress_out, threshold):
     """
     click.echo(f"  Thresholding orientations to {threshold * 100}%")  # Gets file name from the path
     percent = threshold
-    threshold_count = threshold_counts(healpix_counts_dict, percent)
-
-    # set aside the views le percentile
-    included_df = particles_df[particles_df['healpix_counts'] <= threshold_count]
-    for_resampling = particles_df[particles_df['healpix_counts'] > threshold_count]
-    resampled = for_resampling.groupby('healpix').sample(n=threshold_count)
-
-    included_df = pd.concat([included_df, resampled])
-    excluded_df = particles_df[~particles_df.index.isin(included_df.index)]
-    dict_from_counts(particles_df, npix)
-    included_dict = dict_from_counts(included_df, npix)
-    excluded_dict = dict_from_counts(excluded_df, npix)
-    neg_excluded_dict = {key: value * -1 for key, value in excluded_dict.items()}
-    for_plt_ex = sorted(neg_excluded_dict.values(), reverse=True)
-    data_array = np.array(for_plt_ex, dtype=float)
-    data_array[data_array == 0] = np.nan
-    for_plt_ex = data_array.tolist()
+    if stratify:
+        # each stratum gets its own threshold
+        strata_counts = counts.reshape(len(strata_names), -1)
+        strata_thresholds = np.array([threshold_counts(row, percent) for row in strata_counts])
+        threshold_count = np.repeat(strata_thresholds, strata_counts.shape[1])
+    else:
+        threshold_count = threshold_counts(counts, percent)
+
+    # keep every view le percentile, and randomly resample the rest down to it
+    included = downsample(pixels, counts, threshold_count, seed)
+    included_df = particles_df[included]
+    excluded_df = particles_df[~included]
+    included_counts = healpix_counts(pixels[included], npix)
+    excluded_counts = healpix_counts(pixels[~included], npix)
+
+    if stratify:
+        summary_df = stratum_summary(strata_names, stratify, strata_counts, included_counts.reshape(strata_counts.shape), strata_thresholds)
+        click.echo("\n" + summary_df.to_string(index=False))
+    for_plt_ex = -np.sort(excluded_counts).astype(float)
+    for_plt_ex[for_plt_ex == 0] = np.nan
 
     marker = cycle(('.', 'x'))
 
@@ -189,42 +261,48 @@ def cli(input, prefix, suppress_out, threshold):
     fig = plt.figure(figsize=(8, 6), layout='tight')
     axis = 1
     axis_labels = ('$\\phi$ (rlnAngleRot, deg)', '$\\theta$ (rlnAngleTilt, deg)')
-    histogram2d(fig, axis, particles_df, data_column_x, data_column_y, 'All Particles', *axis_labels, (2, 1))
-    histogram2d(fig, axis, included_df, data_column_x, data_column_y, 'Included Particles', *axis_labels, (2, 3))
-    histogram2d(fig, axis, excluded_df, data_column_x, data_column_y, 'Excluded Particles', *axis_labels, (2, 4))
+    gridsize = gridsize_for_order(k)
+    histogram2d(fig, axis, particles_df, data_column_x, data_column_y, 'All Particles', *axis_labels, (2, 1), gridsize, engine)
+    histogram2d(fig, axis, included_df, data_column_x, data_column_y, 'Included Particles', *axis_labels, (2, 3), gridsize, engine)
+    histogram2d(fig, axis, excluded_df, data_column_x, data_column_y, 'Excluded Particles', *axis_labels, (2, 4), gridsize, engine)
 
     ax = fig.add_subplot(3, 2, 2)
     #sorted_hp_counts_dict = sorted(healpix_counts_dict)
-    ax.plot(sorted(included_dict.values()), marker=next(marker))
+    ax.plot(np.sort(included_counts), marker=next(marker))
     ax.plot(for_plt_ex, marker=next(marker))
-    plt.fill_between(range(npix), sorted(included_dict.values()), color='skyblue', alpha=0.2)
-    plt.fill_between(range(npix), sorted(neg_excluded_dict.values(), reverse=True), color='orange', alpha=0.2)
+    plt.fill_between(range(npix), np.sort(included_counts), color='skyblue', alpha=0.2)
+    plt.fill_between(range(npix), -np.sort(excluded_counts), color='orange', alpha=0.2)
     ax.set(xlabel='view (HEALPix index)', ylabel='# of particles', title='counts')
 
-    # sorting output file names
+    # sorting output file names, each input gets its own prefix when headless
+    if headless:
+        stem = input.split('/')[-1].removesuffix('.star')
+        prefix = f"{prefix}_{stem}" if prefix else stem
+
     if not prefix:
         prefix = ""
     else:
         prefix = f"{prefix}_"
 
-    pdf_filename = f"{prefix}rebalance.pdf"
+    pdf_filename = f"{prefix}rebalance.{fmt}"
     included_filename = f"{prefix}included.star"
     excluded_filename = f"{prefix}excluded.star"
+    summary_filename = f"{prefix}rebalance_summary.csv"
 
+    # save before showing, a shown figure may already be gone
     if not suppress_out:
         # histogram.figsize = (11.80, 8.85)
-        # histogram.dpi = 300
-        plt.show()
         click.echo(f"\n  Saving plots to {pdf_filename}.")
-        plt.savefig(pdf_filename)
+        plt.savefig(pdf_filename, dpi=dpi)
     else:
         click.echo("\n  Saving outputs is suppressed.")
+
+    if headless:
+        plt.close(fig)
+    else:
         plt.show()
 
     if not suppress_out:
-        included_df = included_df.drop(columns=['rlnAngleRot_RAD', 'rlnAngleTilt_RAD', 'healpix', 'healpix_counts'])
-        excluded_df = excluded_df.drop(columns=['rlnAngleRot_RAD', 'rlnAngleTilt_RAD', 'healpix', 'healpix_counts'])
-
         click.echo(f"  Writing {len(included_df)} rebalanced particles to \"{included_filename}\"...")
         df['particles'] = included_df
         starfile.write(df, included_filename)
@@ -233,6 +311,50 @@ def cli(input, prefix, suppress_out, threshold):
         df['particles'] = excluded_df
         starfile.write(df, excluded_filename)
 
+        if stratify:
+            click.echo(f"  Writing the per {stratify} summary to \"{summary_filename}\"...")
+            summary_df.to_csv(summary_filename, index=False)
+
+        return pdf_filename
+
+
+@click.command(no_args_is_help=True)
+@click.option('--i', '--input', 'input', required=False, type=click.Path(exists=True, resolve_path=False), help="Path to the input .star file", metavar='<starfile.star>')
+@click.option('--t', '--threshold', 'threshold', required=True, default=0.8, type=float, help="Percent particles to keep.", metavar='0.8')
+@click.option('--ns', '--no_save', 'suppress_out', flag_value=True, help="Analyze only. Do not save the plots or STAR files.")
+@click.option('--p', '--prefix', 'prefix', help="Prefix for the output files.", metavar='<prefix_output.star>')
+@click.option('--s', '--seed', 'seed', type=int, help="Seed for resampling. The same seed gives the same output.", metavar='<seed>')
+@click.option('--k', '--healpix_order', 'healpix_order', type=click.IntRange(0, MAX_HEALPIX_ORDER), default=3, show_default=True, help="HEALPix order used to bin views.", metavar='<order>')
+@click.option('--auto_order', is_flag=True, help="Pick the HEALPix order from the number of particles and --occupancy.")
+@click.option('--adaptive', is_flag=True, help="Merge pixels with fewer than --occupancy particles into their parent pixels before thresholding.")
+@click.option('--occupancy', type=int, default=30, show_default=True, help="Target particles per pixel for --auto_order and --adaptive.", metavar='<n>')
+@click.option('--by', 'stratify', type=click.Choice(['rlnClassNumber', 'rlnOpticsGroup']), help="Rebalance the views of each class or optics group separately.")
+@click.option('--engine', 'engine', type=click.Choice(['raster', 'hexbin']), default='raster', show_default=True, help="'raster' counts on a regular grid and draws one image, so plots stay small.")
+@click.option('--batch', 'batch', multiple=True, help="Run headless on every .star file matching this path or glob, writing one set of outputs per file. Can be passed multiple times.", metavar='<"*.star">')
+@click.option('--format', 'fmt', type=click.Choice(['pdf', 'png']), default='pdf', show_default=True, help="Plot format.")
+@click.option('--dpi', 'dpi', type=int, default=300, show_default=True, help="Resolution of the saved plots.")
+@click.option('--w', '--workers', 'workers', type=int, help="Number of files to rebalance at once with --batch.", metavar='<n>')
+def cli(input, prefix, suppress_out, threshold, seed, healpix_order, auto_order, adaptive, occupancy, stratify, engine, batch, fmt, dpi, workers):
+
+    options = {'prefix': prefix, 'suppress_out': suppress_out, 'threshold': threshold, 'seed': seed,
+               'healpix_order': healpix_order, 'auto_order': auto_order, 'adaptive': adaptive,
+               'occupancy': occupancy, 'stratify': stratify, 'engine': engine, 'fmt': fmt, 'dpi': dpi}
+
+    if batch and input is not None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Pass either '--i' or '--batch', not both.")
+        exit()
+
+    # headless, one set of outputs per file, never shown
+    if batch:
+        run_batch(rebalance, expand_inputs(batch), workers, headless=True, **options)
+        return
+
+    if input is None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing option '--i' (or '--batch').")
+        exit()
+
+    rebalance(input, **options)
+
 
 if __name__ == '__main__':
     cli(max_content_width=180)
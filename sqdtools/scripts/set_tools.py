@@ -1,7 +1,11 @@
-# import numpy as np
+import numpy as np
 import click
 import starfile
 import pandas as pd
+import concurrent.futures
+import io
+from string import ascii_uppercase
+from sqdtools.scripts.star_io import scan_header
 
 def validate_extension(path, extension):
     if path.endswith(extension):
@@ -10,6 +14,325 @@ def validate_extension(path, extension):
         click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Wrong file format. \"{path}\" does not end with \"{extension}\".")
         raise ValueError()
 
+def hash_keys(dfs, data_columns) -> list[np.ndarray]:
+    """
+    Hashes the data columns of every table into one int64 key per row.
+    Rows with equal values in different tables get equal keys, so set operations become integer lookups.
+    Keys are dense, running from 0 to the number of distinct entries.
+    """
+    keys = np.zeros(sum(len(df) for df in dfs), dtype=np.int64)
+
+    for column in data_columns:
+        codes, uniques = pd.factorize(pd.concat([df[column] for df in dfs], ignore_index=True), use_na_sentinel=False)
+        # refactorize so keys stay dense and never overflow
+        keys, _ = pd.factorize(keys * len(uniques) + codes)
+
+    return np.split(keys, np.cumsum([len(df) for df in dfs])[:-1])
+
+
+def membership_masks(keys_A, keys_B) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns masks of the rows of A found in B, and of the rows of B found in A.
+    """
+    return np.isin(keys_A, keys_B), np.isin(keys_B, keys_A)
+
+
+def read_table(input_file) -> tuple[dict, pd.DataFrame, str]:
+    """
+    Reads a STAR file and picks out its 'micrographs' or 'particles' table.
+    """
+    validate_extension(input_file, '.star')
+    star = starfile.read(input_file)
+
+    # Parses dictionary of starfile data tables
+    if isinstance(star, pd.DataFrame):
+        return star, star, 'items'
+    elif 'micrographs' in star.keys():
+        return star, star['micrographs'], 'micrographs'
+    elif 'particles' in star.keys():
+        return star, star['particles'], 'particles'
+
+
+def header_table(input_file) -> tuple[str, list[str]]:
+    """
+    Picks the 'micrographs' or 'particles' table and its columns from the header only, as read_table does from the parsed file.
+    Other files give 'items' and the columns of their first loop.
+    """
+    blocks = scan_header(input_file)
+    for table in ('micrographs', 'particles'):
+        if table in blocks:
+            return table, blocks[table]
+    loops = [labels for labels in blocks.values() if labels]
+    return 'items', loops[0] if loops else []
+
+
+def check_columns(data_columns, valid_data_columns, description):
+    """
+    Prints the valid data columns and quits on "list", or on a column that is not valid.
+    """
+    bad_columns = [column for column in data_columns if column not in valid_data_columns]
+    if "list" in data_columns or bad_columns:
+        if "list" not in data_columns:
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} {', '.join(f'"{x}"' for x in bad_columns)} not in {description}.")
+        click.echo(f"\n  The following are valid data_column names in {description}:")
+        for item in sorted(valid_data_columns):
+            print(f"    {item}")
+        exit()
+
+
+def membership_matrix(keys) -> np.ndarray:
+    """
+    Builds a (files x entries) boolean matrix of which file contains each distinct entry.
+    """
+    n_keys = max((file_keys.max() + 1 for file_keys in keys if len(file_keys)), default=0)
+    matrix = np.zeros((len(keys), n_keys), dtype=bool)
+    for row, file_keys in zip(matrix, keys):
+        row[file_keys] = True
+    return matrix
+
+
+def write_table(df_type, table_df, file_df, output_file, description):
+    if df_type == 'items':
+        click.echo(f'    File is not the usual RELION STAR format. Skipping {description}...')
+    elif len(table_df) == 0:
+        click.echo(f'    0 particles in {description}. Skipping writing...')
+    else:
+        starfile.write({'optics': file_df['optics'], df_type: table_df}, output_file)
+        click.echo(f'    Wrote {len(table_df):,} {df_type} in {description} to \"{output_file}\".')
+
+
+def n_way(input_files, operation, data_column, membership, workers):
+    """
+    Set operations over any number of STAR files. Each file is parsed once, in parallel,
+    and hashed into one key index that every output is sliced from.
+    """
+    if len(input_files) > len(ascii_uppercase):
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} At most {len(ascii_uppercase)} input files are supported.")
+        exit()
+    labels = ascii_uppercase[:len(input_files)]
+
+    # Check data columns from the headers only
+    data_columns = list(set(data_column))
+    valid_data_columns = set.intersection(*(set(header_table(input_file)[1]) for input_file in input_files))
+    check_columns(data_columns, valid_data_columns, "every file")
+
+    # Parse the files concurrently
+    with concurrent.futures.ThreadPoolExecutor(workers) as exe:
+        tables = list(exe.map(read_table, input_files))
+    stars, dfs, df_types = zip(*tables)
+
+    for label, input_file, df, df_type in zip(labels, input_files, dfs, df_types):
+        click.echo(f"  Read \"{input_file}\" as file {label}.")
+        click.echo(f'    {len(df):,} {df_type} in file {label}.')
+
+    # Hash every file once and find which files hold each entry
+    keys = hash_keys(dfs, data_columns)
+    matrix = membership_matrix(keys)
+    in_every_file = matrix.all(axis=0)
+    in_one_file = matrix.sum(axis=0) == 1
+
+    if operation == 'intersect':
+        click.echo(f'\n  Intersecting {len(input_files)} files on {", ".join(f'"{x}"' for x in data_columns)}...')
+        for label, star, df, df_type, file_keys in zip(labels, stars, dfs, df_types, keys):
+            write_table(df_type, df[in_every_file[file_keys]], star, f"{labels}_intersect_keeping{label}.star", f"the intersection of {labels} (keeping {label})")
+
+    click.echo(f'\n  Taking unique entries on {", ".join(f'"{x}"' for x in data_columns)}...')
+    for label, star, df, df_type, file_keys in zip(labels, stars, dfs, df_types, keys):
+        write_table(df_type, df[in_one_file[file_keys]], star, f"{label}_unique.star", f"{label} unique")
+
+    # Bit i of the membership column is set if the entry is in file i
+    if membership:
+        click.echo('\n  Writing membership columns...')
+        bits = (matrix.astype(np.int64) << np.arange(len(input_files))[:, None]).sum(axis=0)
+        for label, star, df, df_type, file_keys in zip(labels, stars, dfs, df_types, keys):
+            write_table(df_type, df.assign(rlnSetMembership=bits[file_keys]), star, f"{label}_membership.star", f"{label} with membership")
+
+
+def loop_labels(input_file) -> tuple[str, list[str]]:
+    """
+    Reads only the header of a STAR file, up to the first row of the 'micrographs' or 'particles' loop.
+    Returns the table name and its column labels.
+    """
+    table, labels = header_table(input_file)
+    if table not in ('micrographs', 'particles') or not labels:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} \"{input_file}\" has no 'micrographs' or 'particles' loop. Streaming needs the usual RELION STAR format.")
+        exit()
+
+    return table, labels
+
+
+def iter_rows(input_file, table):
+    """
+    Streams a STAR file line by line. Yields (line, is_row), where is_row is True for the rows of the table's loop.
+    """
+    in_table = in_loop = False
+    with open(input_file, 'r') as file:
+        for line in file:
+            stripped = line.strip()
+            if stripped.startswith('data_'):
+                in_table, in_loop = stripped == f'data_{table}', False
+            elif in_table and stripped == 'loop_':
+                in_loop = True
+            elif in_loop and stripped and not stripped.startswith(('_', '#')):
+                yield line, True
+                continue
+            yield line, False
+
+
+def hash_rows(rows, columns) -> np.ndarray:
+    """
+    Hashes the selected columns of raw STAR rows into one uint64 per row.
+    Values are compared as written in the file.
+    """
+    chunk = pd.read_csv(io.StringIO(''.join(rows)), sep=r'\s+', header=None, usecols=columns, dtype=str, quotechar='"')
+    return pd.util.hash_pandas_object(chunk[columns], index=False).to_numpy()
+
+
+def stream_keys(input_file, data_columns, chunk_size=1_000_000) -> tuple[str, np.ndarray]:
+    """
+    First streaming pass. Builds the key index of a STAR file, 8 bytes per row,
+    while holding at most 'chunk_size' rows in memory.
+    """
+    table, labels = loop_labels(input_file)
+    missing_columns = [column for column in data_columns if column not in labels]
+    if missing_columns:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} {', '.join(missing_columns)} not in \"{input_file}\".")
+        exit()
+    columns = [labels.index(column) for column in data_columns]
+
+    hashes, rows = [], []
+    for line, is_row in iter_rows(input_file, table):
+        if is_row:
+            rows.append(line)
+            if len(rows) == chunk_size:
+                hashes.append(hash_rows(rows, columns))
+                rows = []
+    if rows:
+        hashes.append(hash_rows(rows, columns))
+
+    return table, np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+
+def stream_split(input_file, table, mask, outputs):
+    """
+    Second streaming pass. Copies every row to outputs[True] or outputs[False] by its mask value.
+    Header lines and other tables are copied to every output. Outputs that are None are not written.
+    """
+    files = {kept: open(path, 'w') for kept, path in outputs.items() if path}
+    try:
+        row = 0
+        for line, is_row in iter_rows(input_file, table):
+            if not is_row:
+                for file in files.values():
+                    file.write(line)
+                continue
+            file = files.get(bool(mask[row]))
+            if file:
+                file.write(line)
+            row += 1
+    finally:
+        for file in files.values():
+            file.close()
+
+
+def stream_a_b(input_file_a, input_file_b, operation, data_column):
+    """
+    Out of core --intersect and --unique. Memory is bounded by the key index, not the width of the tables.
+    """
+    validate_extension(input_file_a, '.star')
+    validate_extension(input_file_b, '.star')
+
+    # Check data columns from the headers only
+    data_columns = list(set(data_column))
+    valid_data_columns = set(loop_labels(input_file_a)[1]) & set(loop_labels(input_file_b)[1])
+    check_columns(data_columns, valid_data_columns, "file A and in file B")
+
+    click.echo(f"  Streaming \"{input_file_a}\" as file A.")
+    A_type, keys_A = stream_keys(input_file_a, data_columns)
+    click.echo(f'    {len(keys_A):,} {A_type} in file A.')
+    click.echo(f"  Streaming \"{input_file_b}\" as file B.")
+    B_type, keys_B = stream_keys(input_file_b, data_columns)
+    click.echo(f'    {len(keys_B):,} {B_type} in file B.')
+
+    A_in_B, B_in_A = membership_masks(keys_A, keys_B)
+
+    click.echo(f'\n  Writing {operation} outputs on {", ".join(f'"{x}"' for x in data_columns)}...')
+    for label, other_label, input_file, table, mask in (("A", "B", input_file_a, A_type, A_in_B), ("B", "A", input_file_b, B_type, B_in_A)):
+        n_intersect = int(mask.sum())
+        intersect_out = f"{label}n{other_label}_keeping{label}.star" if operation == 'intersect' and n_intersect else None
+        unique_out = f"{label}_unique.star" if n_intersect < len(mask) else None
+        stream_split(input_file, table, mask, {True: intersect_out, False: unique_out})
+
+        if operation == 'intersect':
+            click.echo(f'    {n_intersect:,} {table} in {label} intersect {other_label}.' + (f' Wrote \"{intersect_out}\".' if intersect_out else ' Skipping writing...'))
+        click.echo(f'    {len(mask) - n_intersect:,} {table} in {label} unique.' + (f' Wrote \"{unique_out}\".' if unique_out else ' Skipping writing...'))
+
+
+def neighbor_pairs(micrographs, x, y, radius) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds every pair of particles on the same micrograph that are closer than 'radius'.
+    Particles are hashed into a uniform grid of 'radius' sized cells, so only the
+    particles in neighboring cells are compared.
+    """
+    mic_codes, _ = pd.factorize(micrographs)
+    cell_x = ((x - x.min()) // radius).astype(np.int64) + 1
+    cell_y = ((y - y.min()) // radius).astype(np.int64) + 1
+    n_x, n_y = cell_x.max() + 2, cell_y.max() + 2
+    cells = (mic_codes.astype(np.int64) * n_y + cell_y) * n_x + cell_x
+
+    order = np.argsort(cells, kind='stable')
+    sorted_cells = cells[order]
+    particles = np.arange(len(cells))
+
+    pairs_i, pairs_j = [], []
+    # half of the 3x3 neighborhood, so each pair of cells is visited once
+    for d_x, d_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        neighbors = cells + d_y * n_x + d_x
+        start = np.searchsorted(sorted_cells, neighbors, side='left')
+        counts = np.searchsorted(sorted_cells, neighbors, side='right') - start
+
+        # expand each particle's [start, end) range of neighbors
+        i = np.repeat(particles, counts)
+        j = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+        close = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 < radius ** 2
+        if (d_x, d_y) == (0, 0):
+            close &= i < j
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def suppress_neighbors(pairs_i, pairs_j, scores) -> np.ndarray:
+    """
+    Keeps the best scoring particle of every group of close particles, like greedy non-maximum suppression.
+    Each round keeps the undecided particles without a better undecided neighbor and removes their neighbors.
+    Returns a mask of the particles to keep.
+    """
+    # rank 0 is the best score, ties go to the first particle
+    rank = np.empty(len(scores), dtype=np.int64)
+    rank[np.lexsort((np.arange(len(scores)), -np.asarray(scores)))] = np.arange(len(scores))
+
+    # both directions of every pair
+    i = np.concatenate([pairs_i, pairs_j])
+    j = np.concatenate([pairs_j, pairs_i])
+
+    undecided = np.ones(len(scores), dtype=bool)
+    keep = np.zeros(len(scores), dtype=bool)
+    while undecided.any():
+        active = undecided[i] & undecided[j]
+        has_better = np.zeros(len(scores), dtype=bool)
+        has_better[i[active & (rank[j] < rank[i])]] = True
+
+        kept = undecided & ~has_better
+        keep |= kept
+        undecided &= ~kept
+        undecided[j[kept[i]]] = False
+
+    return keep
+
+
 def write_unique(df_type, label, unique_df, file_df):
     if df_type == 'items':
         click.echo(f'    File {label} is not the usual RELION STAR format. Skipping...')
@@ -60,117 +383,125 @@ def write_drop_duplicates(df_type, unique_df, file_df, input_file):
 
 
 @click.command(no_args_is_help=True)
-@click.option('--a', '--input_a', 'input_file_a', required=True, type=click.Path(exists=True, resolve_path=False), help="Path to input .star file A.", metavar='<starfile_A.star>')
+@click.option('--a', '--input_a', 'input_file_a', required=False, type=click.Path(exists=True, resolve_path=False), help="Path to input .star file A.", metavar='<starfile_A.star>')
 @click.option('--b', '--input_b', 'input_file_b', required=False, type=click.Path(exists=True, resolve_path=False), help="Path to input .star file B.", metavar='<starfile_B.star>')
 @click.option('--n', '--intersect', 'operation', flag_value='intersect', default=True, help="Intesect file A with file B. Four files will be written. AnB(keeping A).star, A_unique.star, BnA(keeping B).star, and B_unique.star.")
 @click.option('--u', '--unique', 'operation', flag_value='unique', help="operation xyz")
-@click.option('--d', '--drop_duplicates', 'operation', flag_value='drop_duplicates', help="operation xyz")
-@click.option('--data_column', 'data_column', multiple=True, required=True, type=str, help="RELION data column to select. \"list\" will print valid data column names.", metavar='<rlnDataColumn>')
+@click.option('--d', '--drop_duplicates', 'operation', flag_value='drop_duplicates', help="Drop duplicate entries in file A. With --radius, drop picks that are close together.")
+@click.option('--data_column', 'data_column', multiple=True, required=False, type=str, help="RELION data column to select. \"list\" will print valid data column names. Not needed with --radius.", metavar='<rlnDataColumn>')
+@click.option('--r', '--radius', 'radius', type=float, help="With --drop_duplicates, remove picks on the same micrograph closer than this many pixels.", metavar='<pixels>')
+@click.option('--score_column', 'score_column', default='rlnAutopickFigureOfMerit', show_default=True, help="With --radius, the pick with the highest value in this column is kept.", metavar='<rlnDataColumn>')
+@click.option('--i', '--inputs', 'input_files', multiple=True, type=click.Path(exists=True, resolve_path=False), help="Path to an input .star file. Pass two or more to intersect or take unique entries across all of them instead of --a and --b.", metavar='<starfile.star>')
+@click.option('--membership', is_flag=True, help="With --i, also write each file with a \"rlnSetMembership\" column. Bit n is set if the entry is in the n-th input file.")
+@click.option('--stream', is_flag=True, help="Stream --a and --b from disk in two passes, for files larger than memory. Data columns are compared as written in the files.")
+@click.option('--w', '--workers', 'workers', type=int, help="With --i, number of files to parse in parallel.", metavar='<n>')
 #@click.option('--o', '--output', 'out', is_flag=False, flag_value=None, help="Optional name to add for the output files.", metavar='<output_starfile.star>')
 
 
-def cli(input_file_a, input_file_b, operation, data_column):
-    
+def cli(input_file_a, input_file_b, operation, data_column, radius, score_column, input_files, membership, stream, workers):
+
+    if not data_column and not (operation == 'drop_duplicates' and radius):
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing option '--data_column'.")
+        exit()
+
+    if input_files:
+        if len(input_files) < 2 or operation == 'drop_duplicates':
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} --i needs at least two files, and supports --intersect and --unique.")
+            exit()
+        n_way(input_files, operation, data_column, membership, workers)
+        return
+
+    if input_file_a is None:
+        click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} Missing option '--a' (or two or more '--i').")
+        exit()
+
+    if stream:
+        if input_file_b is None or operation == 'drop_duplicates':
+            click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} --stream needs --a and --b, and supports --intersect and --unique.")
+            exit()
+        stream_a_b(input_file_a, input_file_b, operation, data_column)
+        return
+
     if operation == 'drop_duplicates':
         """
         If statement to handle one input file. Future version will allow multiple input files under one flag.This will require refactoring so we will do later.
         """
-        # Read file A
         validate_extension(input_file_a, '.star')
-        star_a = starfile.read(input_file_a)
-
-        # Parses dictionary of starfile data tables
-        if isinstance(star_a, pd.DataFrame):
-            dfA, A_type = star_a, 'items'
-        elif isinstance(star_a, dict):
-            if 'micrographs' in star_a.keys():
-                dfA, A_type = star_a['micrographs'], 'micrographs'
-            elif 'particles' in star_a.keys():
-                dfA, A_type = star_a['particles'], 'particles'
-
-        # Check data columns
+
+        # Check data columns from the header only
         data_columns = list(set(data_column))
-        if "list" in data_columns:
-            valid_data_columns_A = dfA.columns.tolist()
-            valid_data_columns = list(set(valid_data_columns_A))
-            click.echo("\n  The following are valid data_column names:")
-            for item in valid_data_columns:
-                print(f"    {item}")
-            exit()
+        check_columns(data_columns, header_table(input_file_a)[1], "the file")
 
+        # Read file A
+        star_a, dfA, A_type = read_table(input_file_a)
 
         click.echo(f"  Reading \"{input_file_a}\".")
         click.echo(f'    {len(dfA):,} {A_type} in input file.')
 
+        # Remove picks closer than the radius, keeping the best score
+        if radius:
+            coordinate_columns = ['rlnMicrographName', 'rlnCoordinateX', 'rlnCoordinateY', score_column]
+            missing_columns = [column for column in coordinate_columns if column not in dfA.columns]
+            if missing_columns:
+                click.echo(f"  {click.style('ERROR:', fg='red', bold=True)} {', '.join(missing_columns)} not in \"{input_file_a}\".")
+                exit()
+
+            click.echo(f'\n  Finding {A_type} closer than {radius} pixels, keeping the highest \"{score_column}\"...')
+            pairs_i, pairs_j = neighbor_pairs(dfA['rlnMicrographName'].to_numpy(), dfA['rlnCoordinateX'].to_numpy(np.float64), dfA['rlnCoordinateY'].to_numpy(np.float64), radius)
+            keep = suppress_neighbors(pairs_i, pairs_j, dfA[score_column].to_numpy(np.float64))
+            click.echo(f'    {(~keep).sum():,} duplicate picks.')
+            if keep.all():
+                click.echo(f"\n  No duplicates found. Exiting...")
+                exit()
+
+            write_drop_duplicates(A_type, dfA[keep], star_a, input_file_a)
+            return
+
         # Count diplicates
-        n_duplicates = dfA['rlnImageName'].duplicated().sum()
-        n_duplicate_rows = dfA['rlnImageName'].duplicated(keep=False).sum()
-        click.echo(f'    {n_duplicates:,} duplicate {data_columns[0]} entries.')
-        if n_duplicate_rows == 0:
+        n_duplicates = dfA.duplicated(subset=data_columns).sum()
+        click.echo(f'    {n_duplicates:,} duplicate {", ".join(data_columns)} entries.')
+        if n_duplicates == 0:
             click.echo(f"\n  No duplicates found. Exiting...")
             exit()
 
         # Remove duplicates
-        unique_df = dfA.drop_duplicates(subset=data_columns[0])
+        unique_df = dfA.drop_duplicates(subset=data_columns)
         write_drop_duplicates(A_type, unique_df, star_a, input_file_a)
 
 
 
     else:
-        # Read file A
         validate_extension(input_file_a, '.star')
-        star_a = starfile.read(input_file_a)
-
-        # Read file B
         validate_extension(input_file_b, '.star')
-        star_b = starfile.read(input_file_b)
-
-        # Read files
-        if isinstance(star_a, pd.DataFrame):
-            dfA, A_type = star_a, 'items'
-        elif isinstance(star_a, dict):
-            if 'micrographs' in star_a.keys():
-                dfA, A_type = star_a['micrographs'], 'micrographs'
-            elif 'particles' in star_a.keys():
-                dfA, A_type = star_a['particles'], 'particles'
-
-        if isinstance(star_b, pd.DataFrame):
-            dfB, B_type = star_b, 'items'
-        elif isinstance(star_b, dict):
-            if 'micrographs' in star_b.keys():
-                dfB, B_type = star_b['micrographs'], 'micrographs'
-            elif 'particles' in star_b.keys():
-                dfB, B_type = star_b['particles'], 'particles'
-
-        # Check data columns
+
+        # Check data columns from the headers only
         data_columns = list(set(data_column))
-        if "list" in data_columns:
-            valid_data_columns_A = dfA.columns.tolist()
-            valid_data_columns_B = dfB.columns.tolist()
-            valid_data_columns = list(set(valid_data_columns_A) & set(valid_data_columns_B))
-            click.echo("\n  The following are valid data_column names in file A and in file B:")
-            for item in valid_data_columns:
-                print(f"    {item}")
-            exit()
+        valid_data_columns = set(header_table(input_file_a)[1]) & set(header_table(input_file_b)[1])
+        check_columns(data_columns, valid_data_columns, "file A and in file B")
+
+        # Read file A and file B
+        star_a, dfA, A_type = read_table(input_file_a)
+        star_b, dfB, B_type = read_table(input_file_b)
 
         click.echo(f"  Reading \"{input_file_a}\" as file A.")
         click.echo(f"  Reading \"{input_file_b}\" as file B.")
         click.echo(f'    {len(dfA):,} {A_type} in file A.')
         click.echo(f'    {len(dfB):,} {B_type} in file B.')
 
+    if operation in ('intersect', 'unique'):
+        # Hash the data columns once, then take every set from the same masks
+        keys_A, keys_B = hash_keys([dfA, dfB], data_columns)
+        A_in_B, B_in_A = membership_masks(keys_A, keys_B)
+
     if operation == 'intersect':
         click.echo(f'\n  Intersecting files on {", ".join(f'"{x}"' for x in data_columns)}...')
 
         # Take A intersection with B
-        AnB = dfA.merge(dfB[data_columns], on=data_columns, how="inner")
-        A_unique = (dfA.merge(dfB[data_columns], on=data_columns, how="left", indicator=True)
-                   .query('_merge == "left_only"')
-                   .drop(columns="_merge"))
+        AnB = dfA[A_in_B]
+        A_unique = dfA[~A_in_B]
         # Take B intersection with A
-        BnA = dfB.merge(dfA[data_columns], on=data_columns, how="inner")
-        B_unique = (dfB.merge(dfA[data_columns], on=data_columns, how="left", indicator=True)
-           .query('_merge == "left_only"')
-           .drop(columns="_merge"))
+        BnA = dfB[B_in_A]
+        B_unique = dfB[~B_in_A]
 
         write_intersect(A_type, "A", "B", AnB, A_unique, star_a)
         write_intersect(B_type, "B", "A", BnA, B_unique, star_b)
@@ -179,14 +510,10 @@ def cli(input_file_a, input_file_b, operation, data_column):
         click.echo(f'\n  Taking unique entries on {", ".join(f'"{x}"' for x in data_columns)}...')
 
         # Taking unique A
-        A_unique = (dfA.merge(dfB[data_columns], on=data_columns, how="left", indicator=True)
-                    .query('_merge == "left_only"')
-                    .drop(columns="_merge"))
+        A_unique = dfA[~A_in_B]
 
         # Taking unique B
-        B_unique = (dfB.merge(dfA[data_columns], on=data_columns, how="left", indicator=True)
-                    .query('_merge == "left_only"')
-                    .drop(columns="_merge"))
+        B_unique = dfB[~B_in_A]
 
         write_unique(A_type, 'A', A_unique, star_a)
         write_unique(B_type, 'B', B_unique, star_b)
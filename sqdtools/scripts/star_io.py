@@ -0,0 +1,83 @@
+# helpers to read only what is needed from STAR files
+import pandas as pd
+
+# the strings starfile_rs reads as NaN
+NAN_STRINGS = ['nan', 'NaN', '<NA>']
+
+
+def locate_loop(input_file, block_name) -> tuple[list[str], int, int]:
+    """
+    Finds a loop block in a STAR file: its labels, the line its rows start on, and how many rows it has.
+    Rows are only counted, not parsed. A loop with no rows starts on line 0.
+    """
+    name = None
+    labels = []
+    start, n_rows = 0, 0
+    with open(input_file, 'rb') as file:
+        for number, line in enumerate(file):
+            stripped = line.strip()
+            if n_rows:
+                # a loop ends at the first blank line or the next block
+                if not stripped or stripped.startswith((b'data_', b'loop_')):
+                    break
+                if not stripped.startswith(b'#'):
+                    n_rows += 1
+            elif stripped.startswith(b'data_'):
+                if name == block_name:
+                    break
+                name = stripped.removeprefix(b'data_').decode()
+            elif name != block_name or not stripped or stripped.startswith(b'#') or stripped == b'loop_':
+                continue
+            elif stripped.startswith(b'_'):
+                parts = stripped.split()
+                if len(parts) == 1 or parts[1].startswith(b'#'):
+                    labels.append(parts[0].removeprefix(b'_').decode())
+            else:
+                start, n_rows = number, 1
+    return labels, start, n_rows
+
+
+def read_columns(input_file, block_name, columns, dtypes=None) -> pd.DataFrame:
+    """
+    Parses only the given columns of a loop block, in compact dtypes where given, straight from the file.
+    Other columns are skipped unparsed. Falls back to the inferred dtypes if a column does not fit the one asked for.
+    """
+    labels, start, n_rows = locate_loop(input_file, block_name)
+    if not n_rows:
+        return pd.DataFrame(columns=columns)
+
+    def parse(dtype):
+        return pd.read_csv(input_file, sep=r'\s+', header=None, names=labels, usecols=columns, dtype=dtype, skiprows=start, nrows=n_rows,
+                           comment='#', keep_default_na=False, na_values=NAN_STRINGS)
+
+    try:
+        df = parse(dtypes)
+    except (ValueError, OverflowError):
+        df = parse(None)
+    return df[columns]
+
+
+def scan_header(input_file) -> dict[str, list[str]]:
+    """
+    Reads only the block names and loop labels of a STAR file. Rows are skipped unparsed,
+    and reading stops at the first row of the 'micrographs' or 'particles' loop, which RELION writes last.
+    Returns {block name: loop labels}, with no labels for blocks that are not loops.
+    """
+    blocks = {}
+    name = None
+    with open(input_file, 'r') as file:
+        for line in file:
+            stripped = line.strip()
+            if stripped.startswith('data_'):
+                name = stripped.removeprefix('data_')
+                blocks[name] = []
+            elif name is None or not stripped or stripped.startswith('#') or stripped == 'loop_':
+                continue
+            elif stripped.startswith('_'):
+                # a label, or a key and value pair in a block that is not a loop
+                parts = stripped.split()
+                if len(parts) == 1 or parts[1].startswith('#'):
+                    blocks[name].append(parts[0].removeprefix('_'))
+            elif name in ('micrographs', 'particles') and blocks[name]:
+                break
+    return blocks